@@ -0,0 +1,17 @@
+import argparse
+from fs.compression import benchmark
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument("-s", "--size", type=int, default=8,
+                   help="MB of sample data decompressed per codec")
+    p.add_argument("-b", "--block_size", type=int, default=128,
+                   help="Block size in KB")
+    args = p.parse_args()
+
+    for codec, module, speed, selected in benchmark(args.size * 1024 * 1024, args.block_size * 1024):
+        if module is None:
+            print("%-6s %-20s %s" % (codec, '-', 'not installed'))
+        else:
+            print("%-6s %-20s %8.1f MB/s%s" % (codec, module, speed, ' (used)' if selected else ''))
@@ -0,0 +1,63 @@
+import argparse
+import json
+import logging
+import sys
+import fs
+from fs.jffs2 import JffsImage
+from fs.check import CheckError
+
+
+log = logging.getLogger("imageIO")
+log.setLevel(logging.INFO)
+
+
+def progress(done, total):
+    sys.stderr.write("\rChecked %d/%d" % (done, total))
+    if done == total:
+        sys.stderr.write("\n")
+    sys.stderr.flush()
+
+
+def main(imgObj, output, jobs, quiet):
+    errors = imgObj.check(jobs, None if quiet else progress)
+    for error in errors:
+        output.write(json.dumps(error.asDict()) + "\n")
+    kinds = {}
+    for error in errors:
+        kinds[error.kind] = kinds.get(error.kind, 0) + 1
+    log.info("%d errors%s" % (len(errors), "".join(", %s: %d" % item for item in sorted(kinds.items()))))
+    return errors
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    logging.basicConfig(level=logging.INFO)
+
+    p.add_argument("-d", "--debug", action='store_true', dest='debug',
+                   help="turn on debugging output")
+    p.add_argument("-o", "--output", default=None,
+                   help="JSON Lines error report to write (default: stdout)")
+    p.add_argument("-j", "--jobs", type=int, default=1,
+                   help="Number of threads (SquashFS) or processes (JFFS2) checking blocks")
+    p.add_argument("-q", "--quiet", action='store_true', help="no progress output")
+    p.add_argument("rootfs", help="Image file to check")
+    args = p.parse_args()
+    loglevel = logging.INFO
+    if args.debug:
+        loglevel = logging.DEBUG
+    log.setLevel(level=loglevel)
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        # The check scans the whole image again, mount time verification is not needed
+        imgObj = fs.openImage(args.rootfs, loglevel, options={JffsImage: {'verify': 'none'}})
+    except Exception as e:
+        # Tables needed to build the tree are broken
+        error = CheckError('open', None, None, "Can't parse image: %s" % e)
+        output.write(json.dumps(error.asDict()) + "\n")
+        sys.exit(1)
+    if imgObj:
+        errors = main(imgObj, output, args.jobs, args.quiet)
+        sys.exit(1 if errors else 0)
+    log.warning("Unsupported image type!")
+    sys.exit(2)
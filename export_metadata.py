@@ -0,0 +1,48 @@
+import argparse
+import logging
+import sys
+import fs
+
+
+log = logging.getLogger("imageIO")
+log.setLevel(logging.INFO)
+
+
+def printDu(table, depth):
+    for path, size, csize, files in table.du(depth):
+        ratio = (size / csize) if csize else 1.0
+        print("%12d %12d %6.2f %8d  %s" % (size, csize, ratio, files, path))
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    logging.basicConfig(level=logging.INFO)
+
+    p.add_argument("-d", "--debug", action='store_true', dest='debug',
+                   help="turn on debugging output")
+    p.add_argument("-o", "--output", default=None,
+                   help="CSV file to write the metadata table to (default: stdout)")
+    p.add_argument("--du", action='store_true',
+                   help="Print size, compressed size, ratio and file count per directory instead")
+    p.add_argument("--depth", type=int, default=None,
+                   help="Limit the du report to directories this deep")
+    p.add_argument("rootfs", help="Image file to read")
+    args = p.parse_args()
+    loglevel = logging.INFO
+    if args.debug:
+        loglevel = logging.DEBUG
+    log.setLevel(level=loglevel)
+
+    imgObj = fs.openImage(args.rootfs, loglevel)
+    if imgObj:
+        table = imgObj.metadataTable()
+        if args.du:
+            printDu(table, args.depth)
+        elif args.output:
+            with open(args.output, 'w', newline='') as output:
+                table.writeCsv(output)
+        else:
+            table.writeCsv(sys.stdout)
+        sys.exit(0)
+    log.warning("Unsupported image type!")
+    sys.exit(1)
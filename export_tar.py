@@ -0,0 +1,51 @@
+import argparse
+import logging
+import sys
+import time
+import fs
+
+
+log = logging.getLogger("imageIO")
+log.setLevel(logging.INFO)
+
+
+def main(imgObj, output, top, jobs):
+    start = time.monotonic()
+    written = imgObj.exportTar(output, top, jobs)
+    output.flush()
+    log.info("%d bytes written in %.2fs" % (written, time.monotonic() - start))
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    logging.basicConfig(level=logging.INFO)
+
+    p.add_argument("-d", "--debug", action='store_true', dest='debug',
+                   help="turn on debugging output")
+    p.add_argument("-o", "--output", default=None,
+                   help="tar file to write (default: stdout)")
+    p.add_argument("-C", "--top", default='/',
+                   help="Directory (or single entry) of the image to export")
+    p.add_argument("-j", "--jobs", type=int, default=1,
+                   help="Number of threads decoding blocks ahead of the writer")
+    p.add_argument("rootfs", help="Image file to export")
+    args = p.parse_args()
+    loglevel = logging.INFO
+    if args.debug:
+        loglevel = logging.DEBUG
+    log.setLevel(level=loglevel)
+
+    imgObj = fs.openImage(args.rootfs, loglevel)
+    if imgObj:
+        try:
+            if args.output:
+                with open(args.output, 'wb') as output:
+                    main(imgObj, output, args.top, args.jobs)
+            else:
+                main(imgObj, sys.stdout.buffer, args.top, args.jobs)
+        except FileNotFoundError:
+            log.warning("No such path in the image: %s" % args.top)
+            sys.exit(1)
+        sys.exit(0)
+    log.warning("Unsupported image type!")
+    sys.exit(1)
@@ -0,0 +1,24 @@
+import logging
+from fs.squashfs import SquashImage
+from fs.jffs2 import JffsImage
+from fs.source import openSource
+
+
+supported_filesystems = [SquashImage,
+                         JffsImage]
+
+
+def openImage(path, loglevel=logging.INFO, cache=None, options=None):
+    '''
+        Opens path (file, http(s) URL or fs.source.ByteSource) with the
+        first supported image class recognizing it.
+        options maps an image class to extra createObject arguments.
+    '''
+    options = options or {}
+    source = openSource(path)
+    for fscls in supported_filesystems:
+        imgObj = fscls.createObject(source, loglevel, cache, **options.get(fscls, {}))
+        if imgObj:
+            return imgObj
+    source.close()
+    return None
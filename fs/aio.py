@@ -0,0 +1,93 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import fs
+
+
+log = logging.getLogger(__name__)
+
+MAX_INFLIGHT = 4
+
+
+class AsyncImage:
+    '''
+        asyncio facade over SquashImage/JffsImage. Blocking I/O and
+        decompression run in an executor. Reads are split into image
+        blocks; concurrent requests for the same block share a single
+        decode and at most max_inflight decodes run at the same time.
+    '''
+    def __init__(self, image, executor=None, max_inflight=MAX_INFLIGHT):
+        self.image = image
+        self.executor = executor or ThreadPoolExecutor(max_inflight, thread_name_prefix='imageio')
+        self.ownExecutor = executor is None
+        self.blockSize = image.getStatFs()['st_blksize']
+        self.semaphore = asyncio.Semaphore(max_inflight)
+        self.inflight = {}
+
+    @classmethod
+    async def open(cls, path, loglevel=logging.INFO, cache=None, options=None, **kwargs):
+        loop = asyncio.get_running_loop()
+        image = await loop.run_in_executor(None, fs.openImage, path, loglevel, cache, options)
+        if image is None:
+            raise ValueError("Unsupported image type: %s" % path)
+        return cls(image, **kwargs)
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def _decode(self, path, block):
+        async with self.semaphore:
+            data = await self._run(self.image.readRange, path, block * self.blockSize, self.blockSize)
+        if data is None:
+            raise FileNotFoundError(path)
+        return data
+
+    async def _readBlock(self, path, block):
+        key = (path, block)
+        future = self.inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._decode(path, block))
+            self.inflight[key] = future
+            future.add_done_callback(lambda f: self.inflight.pop(key, None))
+        # One cancelled client must not cancel the decode others wait for
+        return await asyncio.shield(future)
+
+    async def read(self, path, offset=0, length=None):
+        if length is None:
+            length = (await self.stat(path))['st_size'] - offset
+        if length <= 0:
+            return b''
+        first = offset // self.blockSize
+        last = (offset + length - 1) // self.blockSize
+        blocks = await asyncio.gather(*[self._readBlock(path, block)
+                                        for block in range(first, last + 1)])
+        skip = offset - first * self.blockSize
+        return b''.join(blocks)[skip:skip + length]
+
+    async def stat(self, path):
+        attrs = await self._run(self.image.getAttrs, path)
+        if attrs is None:
+            raise FileNotFoundError(path)
+        return attrs
+
+    async def readlink(self, path):
+        target = await self._run(self.image.getLnkTarget, path)
+        if target is None:
+            raise FileNotFoundError(path)
+        return target
+
+    async def listdir(self, path):
+        names = await self._run(lambda: list(self.image.listPath(path)))
+        for name in names:
+            yield name
+
+    def close(self):
+        if self.ownExecutor:
+            self.executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
@@ -0,0 +1,88 @@
+from collections import OrderedDict
+import itertools
+import threading
+
+
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+
+_tags = itertools.count(1)
+
+
+def newTag():
+    '''
+        Key prefix keeping the entries of one image (or source) apart
+        from the others in a shared cache.
+    '''
+    return next(_tags)
+
+
+class LRUCache:
+    '''
+        Least-recently-used mapping bounded by the total size in bytes
+        of the cached values. One instance can be shared by any number
+        of files (and images), so a single budget caps the memory spent
+        on decompressed data. With sizeof=lambda v: 1 the budget is a
+        number of entries instead.
+    '''
+    def __init__(self, maxbytes=DEFAULT_CACHE_SIZE, sizeof=len):
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.size = 0
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.items[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        cost = self.sizeof(value)
+        if cost > self.maxbytes:
+            return
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.size -= self.sizeof(old)
+            self.items[key] = value
+            self.size += cost
+            while self.size > self.maxbytes:
+                _, old = self.items.popitem(last=False)
+                self.size -= self.sizeof(old)
+                self.evictions += 1
+
+    def purge(self, tag):
+        '''
+            Drops every entry whose key starts with tag.
+        '''
+        with self.lock:
+            for key in [key for key in self.items if key[0] == tag]:
+                self.size -= self.sizeof(self.items.pop(key))
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.items),
+                'bytes': self.size,
+                'maxbytes': self.maxbytes}
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
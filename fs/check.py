@@ -0,0 +1,36 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from typing import NamedTuple
+
+
+class CheckError(NamedTuple):
+    kind: str       # What failed, e.g. 'metadata', 'block', 'fragment', 'data', 'orphan-inode'
+    offset: int     # Image offset of the broken structure, None if not tied to one
+    inode: int      # Inode number involved, None if unknown
+    detail: str
+
+    def asDict(self):
+        return self._asdict()
+
+
+def runTasks(tasks, jobs=1, progress=None, processes=False):
+    '''
+        Runs callables on a thread (or process) pool and returns their
+        results in task order. progress(done, total) is called after
+        every finished task.
+    '''
+    total = len(tasks)
+    results = [None] * total
+    if jobs <= 1:
+        for i, task in enumerate(tasks):
+            results[i] = task()
+            if progress:
+                progress(i + 1, total)
+        return results
+    pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with pool(jobs) as executor:
+        futures = {executor.submit(task): i for i, task in enumerate(tasks)}
+        for done, future in enumerate(as_completed(futures), 1):
+            results[futures[future]] = future.result()
+            if progress:
+                progress(done, total)
+    return results
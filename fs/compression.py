@@ -1,39 +1,93 @@
 from fs.utils import hexdump
+import importlib
 import logging
+import random
+import threading
+import time
 
 
 log = logging.getLogger(__name__)
 
+# Implementations of each codec, fastest first. The first one that can be
+# imported is used, all of them have the API of the last one.
+CODEC_MODULES = {
+    'zlib': ('isal.isal_zlib', 'zlib_ng.zlib_ng', 'zlib'),
+    'lzma': ('lzma',),
+    'lzo': ('lzo',),
+    'lz4': ('lz4.block',),
+    'zstd': ('zstandard',),
+}
+# Output buffer for codecs that cannot be told the decoded size
+DEFAULT_BUFFER_SIZE = 128 * 1024
+# Raised on malformed input (truncated streams, bad pure Python decodes)
+DECODE_ERRORS = (ValueError, IndexError, EOFError)
+
+
+def resolveCodec(codec):
+    '''
+        Module implementing codec, or None when none is installed.
+    '''
+    for name in CODEC_MODULES[codec]:
+        try:
+            return importlib.import_module(name)
+        except ImportError:
+            continue
+    return None
+
 
 class Compressor:
-    def decompress(self, data, dsize=None):
+    '''
+        decompress() returns at most max_length bytes when it is given,
+        the codecs that can stream stop decoding once they have them.
+        The codec module is resolved once, when the instance is created.
+        errors are the exceptions meaning the input is corrupt, as opposed
+        to a codec which is not installed (NotImplementedError).
+    '''
+    codec = None
+    # Exception classes of the codec module raised for bad input
+    errorNames = ()
+
+    def __init__(self, module=None):
+        self.module = module
+        if module is None and self.codec:
+            self.module = resolveCodec(self.codec)
+        self.errors = DECODE_ERRORS + tuple(getattr(self.module, name) for name in self.errorNames
+                                            if hasattr(self.module, name))
+
+    def decompress(self, data, dsize=None, max_length=None):
         raise NotImplementedError
 
 
 class DummyCompressor(Compressor):
-    def decompress(self, data, dsize=None):
-        return data
+    def decompress(self, data, dsize=None, max_length=None):
+        return data[:max_length]
 
 
 class GzipCompressor(Compressor):
+    codec = 'zlib'
+    errorNames = ('error',)
 
-    def decompress(self, data, dsize=None):
-        import gzip
-        return gzip.decompress(data)
+    def decompress(self, data, dsize=None, max_length=None):
+        zlib = self.module
+        # Accepts both zlib (SquashFS) and gzip headers
+        if max_length is None:
+            return zlib.decompress(data, zlib.MAX_WBITS | 32, dsize or DEFAULT_BUFFER_SIZE)
+        return zlib.decompressobj(zlib.MAX_WBITS | 32).decompress(data, max_length)
 
 
 class ZeroCompressor(Compressor):
-    def decompress(self, data, dsize=None):
-        return '\x00' * dsize
+    def decompress(self, data, dsize=None, max_length=None):
+        return bytes(dsize if max_length is None else min(dsize, max_length))
 
 
 class RTimeCompressor(Compressor):
-    def decompress(self, data, dsize=None):
+    def decompress(self, data, dsize=None, max_length=None):
         positions = [0] * 256
         cpage_out = bytearray([0] * dsize)
         outpos = 0
         pos = 0
-        while outpos < dsize:
+        end = dsize if max_length is None else min(dsize, max_length)
+        while outpos < end:
             value = data[pos]
             pos += 1
             cpage_out[outpos] = value
@@ -53,47 +107,145 @@ class RTimeCompressor(Compressor):
                 else:
                     cpage_out[outpos:outpos + repeat] = cpage_out[backoffs:backoffs + repeat]
                     outpos += repeat
-        return bytes(cpage_out)
+        return bytes(cpage_out[:end])
 
 
 class ZLibCompressor(Compressor):
+    codec = 'zlib'
+    errorNames = ('error',)
 
-    def decompress(self, data, dsize=None):
-        import zlib
-        return zlib.decompress(data)
+    def decompress(self, data, dsize=None, max_length=None):
+        zlib = self.module
+        if max_length is None:
+            return zlib.decompress(data, zlib.MAX_WBITS, dsize or DEFAULT_BUFFER_SIZE)
+        return zlib.decompressobj().decompress(data, max_length)
 
 
 class XZCompressor(Compressor):
+    codec = 'lzma'
+    errorNames = ('LZMAError',)
 
-    def decompress(self, data, dsize=None):
-        import lzma
-        return lzma.decompress(data)
-
+    def decompress(self, data, dsize=None, max_length=None):
+        if max_length is None:
+            return self.module.decompress(data)
+        return self.module.LZMADecompressor().decompress(data, max_length)
 
-class LZMACompressor(Compressor):
 
-    def decompress(self, data, dsize=None):
-        import lzma
-        return lzma.decompress(data)
+class LZMACompressor(XZCompressor):
+    pass
 
 
 class LZOCompressor(Compressor):
+    codec = 'lzo'
 
-    def decompress(self, data, dsize=None):
-        import lzo
+    def decompress(self, data, dsize=None, max_length=None):
+        lzo = self.module
+        if lzo is None:
+            raise NotImplementedError("python-lzo is not installed")
         result = ''
         try:
-            result = lzo.decompress(data, False, dsize)
-            return result
+            # No streaming API, the whole block is decoded
+            result = lzo.decompress(data, False, dsize or DEFAULT_BUFFER_SIZE)
+            return result[:max_length]
         except lzo.error as e:
             log.debug(e)
 
 
 class LZ4Compressor(Compressor):
-    def decompress(self, data, dsize=None):
-        raise NotImplementedError
+    codec = 'lz4'
+    errorNames = ('LZ4BlockError',)
+
+    def decompress(self, data, dsize=None, max_length=None):
+        if self.module is None:
+            raise NotImplementedError("lz4 is not installed")
+        # Block format, the size is only an upper bound for the output
+        return self.module.decompress(data, uncompressed_size=dsize or DEFAULT_BUFFER_SIZE)[:max_length]
 
 
 class ZSTDCompressor(Compressor):
-    def decompress(self, data, dsize=None):
-        raise NotImplementedError
+    codec = 'zstd'
+    errorNames = ('ZstdError',)
+
+    def __init__(self, module=None):
+        Compressor.__init__(self, module)
+        # Decompressor contexts are reused, but cannot be shared by threads
+        self.local = threading.local()
+
+    def decompress(self, data, dsize=None, max_length=None):
+        if self.module is None:
+            raise NotImplementedError("zstandard is not installed")
+        dctx = getattr(self.local, 'dctx', None)
+        if dctx is None:
+            dctx = self.local.dctx = self.module.ZstdDecompressor()
+        if max_length is None:
+            return dctx.decompress(data, max_output_size=dsize or DEFAULT_BUFFER_SIZE)
+        return dctx.decompressobj().decompress(data)[:max_length]
+
+
+class CodecRegistry:
+    '''
+        One shared instance per Compressor class, so codec modules are
+        resolved once instead of on every lookup.
+    '''
+    def __init__(self):
+        self.instances = {}
+        self.lock = threading.Lock()
+
+    def get(self, cls):
+        instance = self.instances.get(cls)
+        if instance is None:
+            with self.lock:
+                instance = self.instances.setdefault(cls, cls())
+        return instance
+
+
+registry = CodecRegistry()
+
+
+def _sampleData(size):
+    rnd = random.Random(0)
+    words = [bytes(rnd.choice(b'abcdefghijklmnopqrstuvwxyz') for i in range(rnd.randint(2, 10)))
+             for j in range(2048)]
+    data = bytearray()
+    while len(data) < size:
+        data += rnd.choice(words) + (b'\n' if rnd.random() < 0.1 else b' ')
+        if rnd.random() < 0.01:
+            data += bytes(rnd.getrandbits(8) for i in range(64))
+    return bytes(data[:size])
+
+
+def benchmark(total=8 * 1024 * 1024, block_size=128 * 1024):
+    '''
+        Decompression speed of every installed implementation of each
+        codec on this machine, as (codec, module name, MB/s, selected)
+        over total bytes of sample data split in block_size blocks.
+        Codecs without any implementation report (codec, None, None, False).
+    '''
+    sample = _sampleData(block_size)
+    compressors = {
+        'zlib': (ZLibCompressor, lambda module: module.compress(sample)),
+        'lzma': (XZCompressor, lambda module: module.compress(sample)),
+        'lzo': (LZOCompressor, lambda module: module.compress(sample, 1, False)),
+        'lz4': (LZ4Compressor, lambda module: module.compress(sample, store_size=False)),
+        'zstd': (ZSTDCompressor, lambda module: module.ZstdCompressor().compress(sample)),
+    }
+    results = []
+    rounds = max(1, total // block_size)
+    for codec, (cls, compress) in compressors.items():
+        selected = registry.get(cls).module
+        if selected is None:
+            results.append((codec, None, None, False))
+            continue
+        for name in CODEC_MODULES[codec]:
+            try:
+                module = importlib.import_module(name)
+            except ImportError:
+                continue
+            compressor = cls(module)
+            cdata = compress(module)
+            start = time.perf_counter()
+            for i in range(rounds):
+                compressor.decompress(cdata, block_size)
+            elapsed = time.perf_counter() - start
+            results.append((codec, name, rounds * block_size / elapsed / 1e6, module is selected))
+    return results
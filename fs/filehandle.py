@@ -0,0 +1,31 @@
+class FileHandle:
+    '''
+        State of one open file: the resolved inode, a reader bound to a
+        precomputed block table, the position after the last read and a
+        private buffer with the block aligned span it decoded last, so
+        small sequential reads do not go back to the image or the cache.
+    '''
+    def __init__(self, inode, size, block_size, reader):
+        self.inode = inode
+        self.size = size
+        self.blockSize = block_size
+        self.reader = reader
+        self.pos = 0
+        self.bufStart = 0
+        self.buf = b''
+
+    def read(self, offset, length):
+        end = min(offset + length, self.size)
+        if offset >= end:
+            return b''
+        if offset < self.bufStart or end > self.bufStart + len(self.buf):
+            start = offset - offset % self.blockSize
+            stop = min(self.size, -(-end // self.blockSize) * self.blockSize)
+            self.buf = self.reader(start, stop - start)
+            self.bufStart = start
+        self.pos = end
+        return self.buf[offset - self.bufStart:end - self.bufStart]
+
+    def close(self):
+        self.buf = b''
+        self.reader = None
@@ -1,31 +1,383 @@
 import logging
-from struct import unpack
+import mmap
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from functools import partial, reduce
+from math import gcd
+from bisect import bisect_left, bisect_right
+from struct import unpack, unpack_from, pack, calcsize, error as StructError
 from fs.jffs2_types import *
-from stat import S_ISDIR
+from fs.cache import LRUCache, newTag
+from fs.pathindex import PathIndex
+from fs.filehandle import FileHandle
+from fs.manifest import ContentRun, hashRuns
+from fs.metadata import MetadataTable
+from fs.source import openSource
+from fs.sharedindex import RecordMap, packMap
+from fs.check import CheckError, runTasks
+from fs.tarexport import TarMember, TAR_TYPES, memberName, writeTar
+import pickle
+import tarfile
+from typing import NamedTuple
+from stat import S_ISDIR, S_ISREG
 
 log = logging.getLogger(__name__)
 
+# Files up to this size are cached as a whole, bigger ones per data node.
+SMALL_FILE_SIZE = 64 * 1024
+# Data nodes never cover more than a page
+PAGE_SIZE = 4096
+
 
 # http://www.inf.u-szeged.hu/projectdirs/jffs2/jffs2-anal/node4.html
 def PAD(x):
     return (((x) + 3) & ~3)
 
 
+# CRC verification policies of data nodes: skip, verify on first read,
+# verify at mount, verify at mount in the background.
+VERIFY_POLICIES = ('none', 'lazy', 'full', 'parallel')
+
+
+class NodeError(NamedTuple):
+    offset: int     # Image offset of the node (or of its data for 'data').
+    kind: str       # 'header', 'node', 'dirent' or 'data'
+    ino: int
+    version: int
+
+
+class NodeIndex:
+    '''
+        Newest dirent of every (parent, name) pair plus, per ino, the
+        newest raw inode and the descriptors of its data nodes. Nodes
+        failing a CRC check are kept in the corruption report.
+    '''
+    def __init__(self):
+        self.nodes = {}
+        self.dirents = {}
+        self.corrupt = {}
+
+    def report(self, offset, kind, ino=None, version=None):
+        log.debug("[Report] Corrupted %s node @ 0x%x" % (kind, offset))
+        self.corrupt[offset] = NodeError(offset, kind, ino, version)
+
+    def scan(self, buf, start, end, endianess, verify=False):
+        '''
+            Scans buf[start:end] for nodes. Headers are parsed straight
+            from the buffer; anything which does not look like a valid
+            node (erased flash, padding, garbage) is skipped by searching
+            for the next magic, so gaps of any size do not stop the scan.
+            With verify the data CRCs are checked as well.
+        '''
+        magic = pack(endianess + "H", JFFS2_MAGIC_BITMASK)
+        hdr_size = calcsize("HHII")
+        pos = start
+        while pos + hdr_size <= end:
+            if buf[pos:pos + 2] != magic:
+                pos = buf.find(magic, pos, end)
+                if pos < 0:
+                    break
+                if pos & 3:
+                    pos = (pos + 3) & ~3
+                    continue
+            try:
+                node = GeneralINode.unpack_from(buf, pos, endianess)
+            except ValueError:
+                log.debug("[Scan] Unknown node type @ 0x%x" % pos)
+                pos += 4
+                continue
+            if not node.hdr_crc_match or node.totlen < hdr_size or pos + node.totlen > end:
+                self.report(pos, 'header')
+                pos += 4
+                continue
+            if node.nodetype == InodeType.JFFS2_NODETYPE_DIRENT:
+                try:
+                    dirent = DirentINode.unpack_from(buf, pos, endianess)
+                except (ValueError, UnicodeDecodeError, StructError):
+                    # CRCs match but the type or the name is not valid
+                    self.report(pos, 'dirent')
+                    pos += PAD(node.totlen)
+                    continue
+                if dirent.node_crc_match and dirent.name_crc_match:
+                    self.addDirent(dirent)
+                else:
+                    self.report(pos, 'dirent', dirent.ino, dirent.version)
+            elif node.nodetype == InodeType.JFFS2_NODETYPE_INODE:
+                inode = RawINode.unpack_from(buf, pos, endianess, verify=verify)
+                if inode is None:
+                    self.report(pos, 'node')
+                else:
+                    self.addINode(inode)
+            pos += PAD(node.totlen)
+
+    def scanSummary(self, buf, start, end, endianess):
+        '''
+            Fills the index from the summary node of the erase block
+            buf[start:end]. Inode nodes are only referenced and parsed
+            on first access (see resolve). Returns False when the block
+            has no valid summary and has to be scanned.
+        '''
+        try:
+            sum_offset, sum_magic = unpack_from(endianess + "II", buf, end - 8)
+            if sum_magic != JFFS2_SUM_MAGIC or sum_offset >= end - start:
+                return False
+            pos = start + sum_offset
+            node = SummaryINode.unpack_from(buf, pos, endianess)
+            if node.nodetype != InodeType.JFFS2_NODETYPE_SUMMARY or \
+                    not node.hdr_crc_match or not node.node_crc_match:
+                return False
+            pos += calcsize("HH7I")
+            if mtd_crc(buf[pos:end]) != node.sum_crc:
+                return False
+            dirents = []
+            refs = []
+            for i in range(node.sum_num):
+                nodetype = unpack_from(endianess + "H", buf, pos)[0]
+                if nodetype == InodeType.JFFS2_NODETYPE_INODE.value:
+                    r = unpack_from(endianess + "HIIII", buf, pos)
+                    refs.append((r[1], start + r[3]))
+                    pos += 18
+                elif nodetype == InodeType.JFFS2_NODETYPE_DIRENT.value:
+                    r = unpack_from(endianess + "HIIIIIBB", buf, pos)
+                    name = bytes(buf[pos + 24:pos + 24 + r[6]])
+                    dirents.append(DirentINode(JFFS2_MAGIC_BITMASK, InodeType.JFFS2_NODETYPE_DIRENT,
+                                               r[1], 0, r[3], r[4], r[5], 0, r[6], FTypes(r[7]),
+                                               0, 0, 0, name.decode('utf-8'), True, True, True))
+                    pos += 24 + r[6]
+                elif nodetype == InodeType.JFFS2_NODETYPE_XATTR.value:
+                    pos += 18
+                elif nodetype == InodeType.JFFS2_NODETYPE_XREF.value:
+                    pos += 6
+                else:
+                    log.debug("[ScanSummary] Unknown record type 0x%x @ 0x%x" % (nodetype, pos))
+                    return False
+        except (ValueError, StructError, UnicodeDecodeError):
+            log.debug("[ScanSummary] Broken summary in block @ 0x%x" % start)
+            return False
+        for dirent in dirents:
+            self.addDirent(dirent)
+        for ino, offset in refs:
+            self.getEntry(ino).setdefault('refs', []).append(offset)
+        return True
+
+    def resolve(self, entry, buf, endianess):
+        '''
+            Parses the inode nodes a summary only referenced.
+        '''
+        refs = entry.pop('refs', None)
+        for offset in refs or ():
+            inode = RawINode.unpack_from(buf, offset, endianess, verify=False)
+            if inode is None:
+                self.report(offset, 'node')
+            else:
+                self.addINode(inode)
+        return entry
+
+    def getEntry(self, ino):
+        entry = self.nodes.get(ino)
+        if entry is None:
+            entry = {'dentry': None, 'inode': None, 'frags': []}
+            self.nodes[ino] = entry
+        return entry
+
+    def addDirent(self, dirent):
+        '''
+            Only the newest dirent of a (parent, name) pair is valid; a
+            newer one with ino 0 marks the name as unlinked.
+        '''
+        key = (dirent.pino, dirent.name)
+        old = self.dirents.get(key)
+        if old is None or dirent.version > old.version:
+            self.dirents[key] = dirent
+
+    def addINode(self, inode):
+        '''
+            Keeps the newest raw inode as the source of metadata and only
+            a DataNode descriptor for the payload of every version.
+        '''
+        entry = self.getEntry(inode.ino)
+        if entry['inode'] is None or inode.version >= entry['inode'].version:
+            entry['inode'] = inode
+        if inode.data_crc_match is False:
+            self.report(inode.data_offset, 'data', inode.ino, inode.version)
+        elif inode.dsize and inode.data_offset not in self.corrupt:
+            entry['frags'].append(DataNode.fromINode(inode))
+
+    def merge(self, other):
+        self.corrupt.update(other.corrupt)
+        for dirent in other.dirents.values():
+            self.addDirent(dirent)
+        for ino, src in other.nodes.items():
+            entry = self.getEntry(ino)
+            if src['inode'] is not None and \
+                    (entry['inode'] is None or src['inode'].version >= entry['inode'].version):
+                entry['inode'] = src['inode']
+            entry['frags'].extend(src['frags'])
+            if 'refs' in src:
+                entry.setdefault('refs', []).extend(src['refs'])
+
+
+def _scanBuffer(buf, start, end, endianess, verify=False):
+    index = NodeIndex()
+    index.scan(buf, start, end, endianess, verify)
+    return index
+
+
+def _scanBlocks(path, start, end, endianess, verify=False):
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return _scanBuffer(mm, start, end, endianess, verify)
+        finally:
+            mm.close()
+
+
+def _verifyNodes(buf, nodes):
+    return [(ino, node) for ino, node in nodes
+            if mtd_crc(buf[node.offset:node.offset + node.csize]) != node.crc]
+
+
+def _verifyFile(path, nodes):
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return _verifyNodes(mm, nodes)
+        finally:
+            mm.close()
+
+
+class FragmentMap:
+    '''
+        Interval map from file ranges to the newest data node covering
+        them. Nodes are applied in version order, so newer data always
+        wins over stale overwritten data, and the result is clipped to
+        the size of the newest inode to honor truncations.
+    '''
+    def __init__(self, nodes, size):
+        self.starts = []
+        self.frags = []     # (start, end, DataNode), sorted, non overlapping
+        for node in sorted(nodes, key=lambda n: n.version):
+            self._insert(node.foffset, node.foffset + node.dsize, node)
+        self._truncate(size)
+
+    def _locate(self, offset):
+        i = bisect_right(self.starts, offset) - 1
+        if i < 0 or self.frags[i][1] <= offset:
+            i += 1
+        return i
+
+    def _insert(self, start, end, node):
+        lo = self._locate(start)
+        hi = bisect_left(self.starts, end)
+        pieces = []
+        if lo < hi and self.frags[lo][0] < start:
+            pieces.append((self.frags[lo][0], start, self.frags[lo][2]))
+        pieces.append((start, end, node))
+        if lo < hi and self.frags[hi - 1][1] > end:
+            pieces.append((end, self.frags[hi - 1][1], self.frags[hi - 1][2]))
+        self.frags[lo:hi] = pieces
+        self.starts[lo:hi] = [item[0] for item in pieces]
+
+    def _truncate(self, size):
+        i = bisect_left(self.starts, size)
+        del self.frags[i:]
+        del self.starts[i:]
+        if self.frags and self.frags[-1][1] > size:
+            start, end, node = self.frags[-1]
+            self.frags[-1] = (start, size, node)
+
+    def overlapping(self, offset, length):
+        end = offset + length
+        i = self._locate(offset)
+        while i < len(self.frags) and self.frags[i][0] < end:
+            yield self.frags[i]
+            i += 1
+
+
 class JffsImage():
-    def __init__(self, path, endianess):
+    def __init__(self, source, endianess, cache=None, jobs=1, erase_size=None, summary=True,
+                 verify='full'):
         self.version = 2
-        self.f = open(path, 'rb')
+        self.source = openSource(source)
+        # Worker processes reopen the image file, other sources are scanned here
+        self.path = self.source.path
         self.endianess = endianess
-        self.nodes = {}
-        self.tree = {'/': {'type': FTypes.DT_DIR, 'sibs': {}, 'id': 1}}
-        self._loadInodeTable()
-        for ino in self.nodes:
-            self._dive(self.tree, self.nodes[ino])
+        self.index = NodeIndex()
+        self.nodes = self.index.nodes
+        self.dirents = self.index.dirents
+        self.cache = cache if cache is not None else LRUCache()
+        self.cacheTag = newTag()
+        if verify not in VERIFY_POLICIES:
+            raise Exception("Unknown verification policy: %s" % verify)
+        self.verify = verify
+        self.verifier = None
+        self.lock = threading.Lock()
+        self._loadInodeTable(jobs, erase_size, summary)
+        if verify == 'full':
+            for ino, node in self._verifyAll(jobs):
+                if node in self.nodes[ino]['frags']:
+                    self.nodes[ino]['frags'].remove(node)
+        elif verify == 'parallel':
+            self.verifier = threading.Thread(target=self._verifyAll, args=(jobs,), daemon=True)
+            self.verifier.start()
+        self._buildTree()
         for ino in self.nodes:
-            if self.nodes[ino]['dentry'].dtype == FTypes.DT_DIR:
-                self.nodes[1] = self._genRootInode(self.nodes[ino])
+            entry = self.nodes[ino]
+            if entry['dentry'] is not None and entry['dentry'].dtype == FTypes.DT_DIR and \
+                    self.index.resolve(entry, self.mm, self.endianess)['inode'] is not None:
+                self.nodes[1] = self._genRootInode(entry)
                 break
 
+    def indexSections(self):
+        '''
+            Node index and path tree as flat sections, see fs.sharedindex.
+            Waits for a background verification to finish first.
+        '''
+        self.waitVerified()
+        meta = {'endianess': self.endianess, 'verify': self.verify, 'corrupt': self.index.corrupt}
+        sections = {'jffs2.meta': pickle.dumps(meta, pickle.HIGHEST_PROTOCOL)}
+        # Fragment maps are rebuilt on demand
+        nodes = {ino: {key: value for key, value in entry.items() if key != 'fragmap'}
+                 for ino, entry in self.nodes.items()}
+        sections['jffs2.inos'], sections['jffs2.nodes'], sections['jffs2.nodes.blob'] = packMap(nodes)
+        sections.update(self.paths.sections())
+        return sections
+
+    @classmethod
+    def fromIndex(cls, source, sections, cache=None):
+        '''
+            Image attached to sections of another process, entries are
+            unpickled on first use.
+        '''
+        self = cls.__new__(cls)
+        meta = pickle.loads(sections['jffs2.meta'])
+        self.version = 2
+        self.source = openSource(source)
+        self.path = self.source.path
+        self.endianess = meta['endianess']
+        self.index = NodeIndex()
+        self.index.nodes = RecordMap(sections['jffs2.inos'], sections['jffs2.nodes'],
+                                     sections['jffs2.nodes.blob'])
+        self.index.corrupt = meta['corrupt']
+        self.nodes = self.index.nodes
+        self.dirents = self.index.dirents
+        self.cache = cache if cache is not None else LRUCache()
+        self.cacheTag = newTag()
+        self.verify = meta['verify']
+        self.verifier = None
+        self.lock = threading.Lock()
+        self.paths = PathIndex.attach(sections)
+        return self
+
+    @property
+    def mm(self):
+        '''
+            Whole image buffer, taken from the source on every use since a
+            suspended source (see fs.pool) maps the file again.
+        '''
+        return self.source.buffer()
+
     def _genRootInode(self, src):
         '''
             JFFS2 does not have root inode. The function generates
@@ -38,125 +390,444 @@ class JffsImage():
                         0, 0, 1, src['dentry'].mctime, 1, src['dentry'].dtype,
                         0, src['dentry'].node_crc, src['dentry'].name_crc, '/',
                         True, True, True)
-        b = RawINode(src['vers'][0].magic, src['vers'][0].nodetype,
-                     src['vers'][0].totlen, src['vers'][0].hdr_crc,
-                     0, 0, src['vers'][0].mode, src['vers'][0].uid, src['vers'][0].gid,
-                     0, src['vers'][0].atime, src['vers'][0].mtime, src['vers'][0].ctime,
-                     0, 0, 0, 0, 0, 0, 0, src['vers'][0].node_crc, b'', True, True)
-        return {'dentry': a, 'vers': [b]}
-
-    def _loadInodeTable(self):
-        retry = 0
-        while True:
-            cpos = self.f.tell()
+        b = RawINode(src['inode'].magic, src['inode'].nodetype,
+                     src['inode'].totlen, src['inode'].hdr_crc,
+                     1, 0, src['inode'].mode, src['inode'].uid, src['inode'].gid,
+                     0, src['inode'].atime, src['inode'].mtime, src['inode'].ctime,
+                     0, 0, 0, 0, 0, 0, 0, src['inode'].node_crc, 0, True, True)
+        return {'dentry': a, 'inode': b, 'frags': []}
+
+    def _loadInodeTable(self, jobs, erase_size, summary):
+        end = len(self.mm)
+        if erase_size is None and (jobs > 1 or summary):
+            erase_size = self._detectEraseSize()
+            if erase_size is None:
+                # Only a parallel load loses anything, summaries are optional
+                log.log(logging.WARNING if jobs > 1 else logging.DEBUG,
+                        "[LoadInodeTable] Can't detect erase block size, scanning whole image.")
+        elif erase_size is not None and erase_size <= 0:
+            log.warning("[LoadInodeTable] Invalid erase block size %d, scanning whole image." % erase_size)
+            erase_size = None
+        if not erase_size:
+            self.index.scan(self.mm, 0, end, self.endianess)
+            return
+        ranges = []
+        summarized = 0
+        for start in range(0, end, erase_size):
+            stop = min(start + erase_size, end)
+            if summary and self.index.scanSummary(self.mm, start, stop, self.endianess):
+                summarized += 1
+            elif ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], stop)
+            else:
+                ranges.append((start, stop))
+        log.debug("[LoadInodeTable] %d erase blocks read from summaries" % summarized)
+        if jobs > 1 and self.path:
+            self._loadParallel(jobs, erase_size, ranges)
+        else:
+            for start, stop in ranges:
+                self.index.scan(self.mm, start, stop, self.endianess)
+
+    def _detectEraseSize(self):
+        '''
+            Cleanmarkers are written at the start of every erase block,
+            summary markers close every summarized one. Sampled blocks need
+            not be adjacent, so the erase size is the gcd of the distances
+            between the markers (of their ends, for summaries).
+        '''
+        marker = pack(self.endianess + "HH", JFFS2_MAGIC_BITMASK,
+                      InodeType.JFFS2_NODETYPE_CLEANMARKER.value)
+        offsets = []
+        pos = self.mm.find(marker)
+        while pos >= 0 and len(offsets) < 16:
+            # Erase blocks are at least page aligned, skips matches in data
+            if pos & 0xFFF == 0:
+                offsets.append(pos)
+            pos = self.mm.find(marker, pos + 4)
+        sizes = [b - a for a, b in zip(offsets, offsets[1:])]
+        if not sizes:
+            marker = pack(self.endianess + "I", JFFS2_SUM_MAGIC)
+            pos = self.mm.find(marker)
+            while pos >= 0 and len(sizes) < 16:
+                if (pos + 4) & 3 == 0:
+                    sizes.append(pos + 4)
+                pos = self.mm.find(marker, pos + 4)
+        if sizes:
+            size = reduce(gcd, sizes)
+            if size >= 0x1000 and (size & (size - 1)) == 0:
+                log.debug("[DetectEraseSize] Erase block size: 0x%x" % size)
+                return size
+        return None
+
+    def _loadParallel(self, jobs, erase_size, ranges):
+        '''
+            Nodes never cross erase block boundaries, so block ranges
+            are scanned independently in a process pool and merged in
+            image order.
+        '''
+        blocks = sum(stop - start for start, stop in ranges) // erase_size
+        step = max(1, blocks // (jobs * 4)) * erase_size
+        starts = []
+        ends = []
+        for start, stop in ranges:
+            for pos in range(start, stop, step):
+                starts.append(pos)
+                ends.append(min(pos + step, stop))
+        with ProcessPoolExecutor(jobs) as pool:
+            for index in pool.map(_scanBlocks, repeat(self.path), starts, ends,
+                                  repeat(self.endianess)):
+                self.index.merge(index)
+
+    def _dataNodes(self):
+        '''
+            Yields (ino, DataNode) of every data node, including the ones
+            only referenced by summaries, without changing the index.
+        '''
+        for ino, entry in list(self.nodes.items()):
+            for node in entry['frags']:
+                yield ino, node
+            for offset in entry.get('refs', ()):
+                inode = RawINode.unpack_from(self.mm, offset, self.endianess, verify=False)
+                if inode is not None and inode.dsize:
+                    yield ino, DataNode.fromINode(inode)
+
+    def _verifyAll(self, jobs):
+        nodes = list(self._dataNodes())
+        if jobs > 1 and self.path:
+            step = max(1, len(nodes) // (jobs * 4))
+            parts = [nodes[i:i + step] for i in range(0, len(nodes), step)]
+            with ProcessPoolExecutor(jobs) as pool:
+                bad = [item for part in pool.map(_verifyFile, repeat(self.path), parts)
+                       for item in part]
+        else:
+            bad = _verifyNodes(self.mm, nodes)
+        for ino, node in bad:
+            self.index.report(node.offset, 'data', ino, node.version)
+        log.debug("[Verify] %d data nodes checked, %d corrupted" % (len(nodes), len(bad)))
+        return bad
+
+    def waitVerified(self, timeout=None):
+        '''
+            Waits for the background verification ('parallel' policy).
+            Returns True once every node has been checked.
+        '''
+        if self.verifier is not None:
+            self.verifier.join(timeout)
+            return not self.verifier.is_alive()
+        return self.verify != 'lazy' and self.verify != 'none'
+
+    def getCorruptionReport(self, path=None):
+        '''
+            Corrupted nodes found so far, sorted by image offset. With a
+            path only the nodes of that file are returned.
+        '''
+        report = sorted(self.index.corrupt.values())
+        if path is not None:
+            inode = self._getINode(path)
+            if inode is None or inode['dentry'] is None:
+                return None
+            report = [item for item in report if item.ino == inode['dentry'].ino]
+        return report
+
+    def check(self, jobs=1, progress=None):
+        '''
+            Integrity check of the whole image, independent of the mount
+            time index: every erase block is scanned again (summaries are
+            ignored) verifying header, node and data CRCs, then the tree
+            is searched for orphaned dirents and inodes. Erase blocks are
+            spread over a process pool, progress(done, total) is called
+            per scanned range. Returns a list of fs.check.CheckError.
+        '''
+        end = len(self.mm)
+        erase_size = self._detectEraseSize()
+        if erase_size is None:
+            log.log(logging.WARNING if jobs > 1 else logging.DEBUG,
+                    "[Check] Can't detect erase block size, scanning whole image.")
+            step = end
+        else:
+            step = max(1, end // erase_size // (max(jobs, 1) * 4)) * erase_size
+        processes = jobs > 1 and self.path
+        scan = partial(_scanBlocks, self.path) if processes else partial(_scanBuffer, self.mm)
+        tasks = [partial(scan, start, min(start + step, end), self.endianess, True)
+                 for start in range(0, end, step)]
+        index = NodeIndex()
+        for part in runTasks(tasks, jobs, progress, processes=processes):
+            index.merge(part)
+
+        details = {'header': "Header CRC mismatch or bad length",
+                   'node': "Inode node CRC mismatch",
+                   'dirent': "Dirent node or name CRC mismatch, or bad type or name",
+                   'data': "Data CRC mismatch"}
+        errors = [CheckError(item.kind, item.offset, item.ino, details.get(item.kind, item.kind))
+                  for item in sorted(index.corrupt.values())]
+
+        dirents = [dirent for dirent in index.dirents.values() if dirent.ino != 0]
+        dirs = {1} | {dirent.ino for dirent in dirents if dirent.dtype == FTypes.DT_DIR}
+        for dirent in dirents:
+            if dirent.pino not in dirs:
+                errors.append(CheckError('orphan-dirent', None, dirent.ino,
+                                         "%s: parent directory %d does not exist" % (dirent.name, dirent.pino)))
+            entry = index.nodes.get(dirent.ino)
+            if entry is None or entry['inode'] is None:
+                errors.append(CheckError('dangling-dirent', None, dirent.ino,
+                                         "%s: no inode node for ino %d" % (dirent.name, dirent.ino)))
+        linked = {dirent.ino for dirent in dirents}
+        for ino, entry in sorted(index.nodes.items()):
+            if ino != 1 and ino not in linked and entry['inode'] is not None:
+                errors.append(CheckError('orphan-inode', None, ino,
+                                         "Inode %d is not linked by any dirent" % ino))
+        log.debug("[Check] %d ranges scanned, %d errors" % (len(tasks), len(errors)))
+        return errors
+
+    def _readNode(self, node, cached=True, ino=None, max_length=None):
+        '''
+            With max_length only the start of an uncached node is decoded
+            and the partial result is not cached.
+        '''
+        key = (self.cacheTag, 'node', node.offset)
+        data = self.cache.get(key) if cached else None
+        if data is None:
+            if node.offset in self.index.corrupt:
+                return None
+            cdata = self.mm[node.offset:node.offset + node.csize]
+            if self.verify == 'lazy' and mtd_crc(cdata) != node.crc:
+                self.index.report(node.offset, 'data', ino, node.version)
+                return None
+            compressor = getCompressor(node.compr)
             try:
-                node = GeneralINode.unpack(self.f, self.endianess)
-                if not node.hdr_crc_match:
-                    log.error("[LoadInodeTable] Node Header CRC missmatch!", node)
-                    raise Exception("Node header corrupted")
-                self.f.seek(cpos)
-                if node.nodetype == InodeType.JFFS2_NODETYPE_CLEANMARKER:
-                    pass
-                elif node.nodetype == InodeType.JFFS2_NODETYPE_DIRENT:
-                    node = DirentINode.unpack(self.f, self.endianess)
-                    if node.ino in self.nodes:
-                        log.error("[LoadInodeTable] Existing ino: ", node)
-                        raise Exception("The dirent already in the log.")
-                    self.nodes[node.ino] = {'vers': [], 'dentry': node}
-                elif node.nodetype == InodeType.JFFS2_NODETYPE_INODE:
-                    node = RawINode.unpack(self.f, self.endianess)
-                    self.nodes[node.ino]['vers'].append(node)
-                offset = PAD(node.totlen)
-                retry = 0
-            except ValueError:
-                log.debug("[LoadInodeTable] Can't unpack node, skipping byte @ 0x%x" % (cpos + offset))
-                offset = 1
-                if retry > 12:
-                    break
-                retry += 1
-            self.f.seek(cpos + offset)
-
-    def _dive(self, tree, item):
-        for fname in tree:
-            if tree[fname]['id'] == item['dentry'].pino:
-                if item['dentry'].dtype == FTypes.DT_DIR:
-                    tree[fname]['sibs'][item['dentry'].name] = {'type': item['dentry'].dtype,
-                                                                'sibs': {},
-                                                                'id': item['dentry'].ino}
-                else:
-                    tree[fname]['sibs'][item['dentry'].name] = {'id': item['dentry'].ino,
-                                                                'type': item['dentry'].dtype,
-                                                                'vers': len(item['vers'])}
-                break
-            elif tree[fname]['type'] == FTypes.DT_DIR:
-                self._dive(tree[fname]['sibs'], item)
+                # A codec which is not installed raises NotImplementedError,
+                # that is no reason to mark the node corrupt
+                data = compressor.decompress(cdata, node.dsize, max_length)
+            except compressor.errors as e:
+                log.debug("[ReadNode] Can't decompress node @ 0x%x: %s" % (node.offset, e))
+                self.index.report(node.offset, 'data', ino, node.version)
+                return None
+            if cached and data is not None and max_length is None:
+                self.cache.put(key, data)
+        return data
+
+    def _buildTree(self):
+        '''
+            Builds the directory hierarchy in a single pass through a
+            parent ino -> children index, independent of the order in
+            which the nodes were found in the image.
+        '''
+        children = {}
+        for dirent in self.dirents.values():
+            if dirent.ino == 0:
+                continue
+            self.index.getEntry(dirent.ino)['dentry'] = dirent
+            children.setdefault(dirent.pino, []).append(dirent)
+        self.paths = PathIndex.build(1, FTypes.DT_DIR.value,
+                                     lambda ino: [(d.name, d.ino, d.dtype.value, d.dtype == FTypes.DT_DIR)
+                                                  for d in children.get(ino, ())])
 
     def listPath(self, path):
-        if path == '/':
-            p = []
-        else:
-            p = path.split('/')[1:]
-        tree = self.tree
-        last = '/'
-        try:
-            for item in p:
-                tree = tree[last]['sibs']
-                last = item
-            if tree[last]['type'] == FTypes.DT_DIR:
-                for item in tree[last]['sibs']:
-                    yield item
-            else:
-                yield last
-        except KeyError:
-            log.debug("[ListPath] Can't find path: %s" % path)
-            return
+        return self.paths.listPath(path)
+
+    def listEntries(self, path, offset=0):
+        return self.paths.entries(path, offset)
+
+    def walk(self, top='/'):
+        return self.paths.walk(top)
+
+    def glob(self, pattern):
+        return self.paths.glob(pattern)
+
+    def find(self, name=None, type=None, min_size=None):
+        '''
+            Paths of the entries matching all given filters, name is an
+            exact name or a shell pattern, type a find(1) letter and
+            min_size only matches regular files.
+        '''
+        for nid in self.paths.find(name, type):
+            if min_size is not None:
+                inode = self._nodeEntry(nid)
+                if inode is None or inode['inode'] is None or not S_ISREG(inode['inode'].mode) \
+                        or inode['inode'].isize < min_size:
+                    continue
+            yield self.paths.path(nid)
+
+    def _getFragmentMap(self, inode):
+        fragmap = inode.get('fragmap')
+        if fragmap is None:
+            fragmap = FragmentMap(inode['frags'], inode['inode'].isize)
+            inode['fragmap'] = fragmap
+        return fragmap
+
+    def _readRange(self, inode, offset, length, cached=True, partial=False):
+        '''
+            partial decodes only as much of each node as the range needs.
+        '''
+        size = inode['inode'].isize
+        length = max(0, min(length, size - offset))
+        data = bytearray(length)
+        for start, end, node in self._getFragmentMap(inode).overlapping(offset, length):
+            lo = max(start, offset)
+            hi = min(end, offset + length)
+            max_length = hi - node.foffset if partial and hi - node.foffset < node.dsize else None
+            chunk = (self._readNode(node, cached, inode['inode'].ino, max_length) or b'')[lo - node.foffset:hi - node.foffset]
+            data[lo - offset:lo - offset + len(chunk)] = chunk
+        return data
+
+    def readRange(self, path, offset, length):
+        '''
+            Reads only the data nodes overlapping the requested range.
+        '''
+        inode = self._getINode(path)
+        if inode is None or inode['inode'] is None:
+            return None
+        return bytes(self._readRange(inode, offset, length))
+
+    def head(self, path, n):
+        '''
+            First n bytes of a file, for file type sniffing.
+        '''
+        inode = self._getINode(path)
+        if inode is None or inode['inode'] is None:
+            return None
+        return bytes(self._readRange(inode, 0, n, partial=True))
+
+    def openFile(self, path):
+        inode = self._getINode(path)
+        if inode is None or inode['inode'] is None:
+            return None
+        self._getFragmentMap(inode)
+        return FileHandle(inode, inode['inode'].isize, PAGE_SIZE,
+                          lambda offset, length: bytes(self._readRange(inode, offset, length)))
+
+    def _rangePiece(self, inode, offset):
+        return bytes(self._readRange(inode, offset, SMALL_FILE_SIZE, cached=False))
+
+    def _filePieces(self, inode):
+        size = inode['inode'].isize
+        for offset in range(0, size, SMALL_FILE_SIZE):
+            yield min(SMALL_FILE_SIZE, size - offset), partial(self._rangePiece, inode, offset)
+
+    def _fileChunks(self, inode):
+        for length, piece in self._filePieces(inode):
+            yield piece()
+
+    def _dataPosition(self, inode):
+        frags = self._getFragmentMap(inode).frags
+        return frags[0][2].offset if frags else 0
+
+    def hashAll(self, algorithm='sha256', jobs=1):
+        '''
+            Hashes every regular file, hardlinks to the same inode are
+            decoded once.
+        '''
+        runs = {}
+        for nid in self.paths.find(type='f'):
+            inode = self._nodeEntry(nid)
+            if inode is None or inode['inode'] is None:
+                continue
+            run = runs.get(inode['inode'].ino)
+            if run is None:
+                run = ContentRun(self._dataPosition(inode), inode['inode'].isize, [],
+                                 partial(self._fileChunks, inode))
+                runs[inode['inode'].ino] = run
+            run.paths.append(self.paths.path(nid))
+        return hashRuns(runs.values(), algorithm, jobs)
+
+    def exportTar(self, stream, top='/', jobs=1):
+        '''
+            Streams a POSIX tar of top (a directory or a single entry) to
+            stream, see fs.tarexport.writeTar. Returns the bytes written.
+        '''
+        nid = self.paths.lookup(top)
+        if nid is None:
+            raise FileNotFoundError(top)
+        top = self.paths.path(nid)
+        nids = self.paths.descendants(nid)[1:] if self.paths.isdir[nid] else [nid]
+        members = []
+        for nid in nids:
+            path = self.paths.path(nid)
+            ttype = TAR_TYPES.get(self.paths.type[nid])
+            inode = self._nodeEntry(nid)
+            if ttype is None or inode is None or inode['inode'] is None:
+                log.debug("[ExportTar] Skipping %s" % path)
+                continue
+            size = position = device = 0
+            linkname = ''
+            pieces = None
+            if ttype == tarfile.REGTYPE:
+                size = inode['inode'].isize
+                position = self._dataPosition(inode)
+                pieces = partial(self._filePieces, inode)
+            elif ttype == tarfile.SYMTYPE:
+                linkname = self._linkTarget(inode) or ''
+            elif ttype in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+                device = self._deviceNumber(inode)
+            members.append(TarMember(memberName(path, top), ttype, inode['inode'].mode, inode['inode'].uid,
+                                     inode['inode'].gid, inode['inode'].mtime, size, linkname,
+                                     device, inode['inode'].ino, position, pieces))
+        return writeTar(stream, members, jobs)
+
+    def metadataTable(self):
+        '''
+            Metadata of every node, read from the node headers only. The
+            compressed size of a file is the sum of its live data nodes.
+        '''
+        table = MetadataTable(self.paths)
+        for nid in range(len(self.paths)):
+            inode = self._nodeEntry(nid)
+            if inode is None or inode['inode'] is None:
+                table.append(nid, self.paths.inode[nid], self.paths.type[nid] << 12, 0, 0, 0, 0, 0, 0)
+                continue
+            size = csize = blocks = 0
+            if S_ISREG(inode['inode'].mode):
+                nodes = {node.offset: node for start, end, node in self._getFragmentMap(inode).frags}
+                size = inode['inode'].isize
+                csize = sum(node.csize for node in nodes.values())
+                blocks = len(nodes)
+            table.append(nid, inode['inode'].ino, inode['inode'].mode, inode['inode'].uid,
+                         inode['inode'].gid, inode['inode'].mtime, size, csize, blocks)
+        return table
 
     def getFileData(self, path):
         inode = self._getINode(path)
-        if inode is None:
+        if inode is None or inode['inode'] is None:
             return None
-        data = None
-        try:
-            data = inode['data']
-        except KeyError:
-            data = bytearray(inode['vers'][0].isize)
-            for item in inode['vers']:
-                data[item.offset:(item.offset + item.dsize)] = item.data    # TODO -> handle data duplication
-            inode['data'] = data
-        return bytes(data)
+        size = inode['inode'].isize
+        if size > SMALL_FILE_SIZE:
+            return bytes(self._readRange(inode, 0, size))
+        key = (self.cacheTag, 'file', inode['inode'].ino)
+        data = self.cache.get(key)
+        if data is None:
+            data = bytes(self._readRange(inode, 0, size, cached=False))
+            self.cache.put(key, data)
+        return data
 
     def _getINode(self, path):
-        if path == '/':
-            p = []
-        else:
-            p = path.split('/')[1:]
-        tree = self.tree
-        last = '/'
-        inode = None
-        try:
-            for item in p:
-                tree = tree[last]['sibs']
-                last = item
-            inode = self.nodes[tree[last]['id']]
-        except KeyError:
+        nid = self.paths.lookup(path)
+        if nid is None:
             log.debug("[GetINode] Can't find iNode by path: %s" % path)
-            pass
+            return None
+        return self._nodeEntry(nid)
+
+    def _nodeEntry(self, nid):
+        inode = self.nodes.get(self.paths.inode[nid])
+        if inode is not None and 'refs' in inode:
+            with self.lock:
+                self.index.resolve(inode, self.mm, self.endianess)
         return inode
 
     def getAttrs(self, path):
         inode = self._getINode(path)
         attrs = None
-        if inode:
-            attrs = {'st_atime': inode['vers'][0].atime,
-                     'st_ctime': inode['vers'][0].ctime,
-                     'st_gid': inode['vers'][0].gid,
-                     'st_mode': inode['vers'][0].mode,
-                     'st_mtime': inode['vers'][0].mtime,
+        if inode and inode['inode']:
+            attrs = {'st_atime': inode['inode'].atime,
+                     'st_ctime': inode['inode'].ctime,
+                     'st_gid': inode['inode'].gid,
+                     'st_mode': inode['inode'].mode,
+                     'st_mtime': inode['inode'].mtime,
                      'st_nlink': 1,
-                     'st_size': inode['vers'][0].isize,
-                     'st_uid': inode['vers'][0].uid,
+                     'st_size': inode['inode'].isize,
+                     'st_uid': inode['inode'].uid,
+                     'st_ino': inode['inode'].ino,
                      'st_blocks': 0}
-            if S_ISDIR(inode['vers'][0].mode):
+            if S_ISDIR(inode['inode'].mode):
                 attrs['st_nlink'] = 2
         return attrs
 
@@ -174,27 +845,83 @@ class JffsImage():
                 'st_blocks': 0,
                 'st_blksize': 131072}
 
+    def _nodeData(self, inode):
+        '''
+            Data of a symlink or device node. Every version (a chmod,
+            chown...) rewrites the whole target or rdev, so the newest
+            readable one is current.
+        '''
+        if inode and inode['frags']:
+            for node in sorted(inode['frags'], key=lambda node: node.version, reverse=True):
+                data = self._readNode(node, ino=inode['inode'].ino if inode['inode'] else None)
+                if data is not None:
+                    return data
+        return None
+
+    def _linkTarget(self, inode):
+        data = self._nodeData(inode)
+        return None if data is None else data.decode('latin-1')
+
+    def _deviceNumber(self, inode):
+        '''
+            rdev stored as the data of a device node, 16 bit (old) or
+            32 bit (new_encode_dev) encoding.
+        '''
+        data = self._nodeData(inode) or b''
+        if len(data) == 2:
+            return unpack(self.endianess + 'H', data)[0]
+        if len(data) == 4:
+            return unpack(self.endianess + 'I', data)[0]
+        return 0
+
     def getLnkTarget(self, path):
-        inode = self._getINode(path)
-        result = None
-        if inode:
-            result = inode['vers'][0].data.decode('latin-1')
-        return result
+        return self._linkTarget(self._getINode(path))
+
+    def _readLink(self, nid):
+        return self._linkTarget(self._nodeEntry(nid))
+
+    def realpath(self, path):
+        '''
+            Canonical path inside the image with all symlinks resolved,
+            None when a component is missing or links loop. Raises
+            NotADirectoryError for a path continuing past a file.
+        '''
+        nid = self.paths.resolve(path, self._readLink)
+        return None if nid is None else self.paths.path(nid)
+
+    def stat(self, path, follow_symlinks=True):
+        nid = self.paths.resolve(path, self._readLink, follow_symlinks)
+        return None if nid is None else self.getAttrs(self.paths.path(nid))
+
+    @staticmethod
+    def _closeOwned(source, path):
+        if source is not path:
+            source.close()
 
     @classmethod
-    def createObject(cls, path, loglevel=logging.INFO):
+    def createObject(cls, path, loglevel=logging.INFO, cache=None, jobs=1, erase_size=None,
+                     summary=True, verify='full'):
+        '''
+            path is an image file, an http(s) URL or any fs.source.ByteSource.
+            JFFS2 is scanned node by node, so sources other than files are
+            read into memory once.
+        '''
         log.setLevel(loglevel)
-        with open(path, 'rb') as f:
-            data = f.read(2)
-            bmagic = unpack('>H', data)[0]
-            lmagic = unpack('<H', data)[0]
-            endianess = None
-            if bmagic == JFFS2_MAGIC_BITMASK:
-                log.info("[CreateObject] Big endian, Jffs2 image.")
-                endianess = ">"
-            elif lmagic == JFFS2_MAGIC_BITMASK:
-                log.info("[CreateObject] Little endian, Jffs2 image.")
-                endianess = "<"
-            else:
-                return None
-            return JffsImage(path, endianess)
+        source = openSource(path)
+        data = source.pread(0, 2)
+        if len(data) < 2:
+            cls._closeOwned(source, path)
+            return None
+        bmagic = unpack('>H', data)[0]
+        lmagic = unpack('<H', data)[0]
+        endianess = None
+        if bmagic == JFFS2_MAGIC_BITMASK:
+            log.info("[CreateObject] Big endian, Jffs2 image.")
+            endianess = ">"
+        elif lmagic == JFFS2_MAGIC_BITMASK:
+            log.info("[CreateObject] Little endian, Jffs2 image.")
+            endianess = "<"
+        else:
+            cls._closeOwned(source, path)
+            return None
+        return JffsImage(source, endianess, cache, jobs, erase_size, summary, verify)
@@ -1,11 +1,12 @@
 from enum import Enum
 from typing import NamedTuple
-from struct import unpack, calcsize
+from struct import unpack_from, calcsize
 import binascii
 from fs.compression import *
 
 
 JFFS2_MAGIC_BITMASK = 0x1985
+JFFS2_SUM_MAGIC = 0x02851885
 
 # /* Compatibility flags. */
 JFFS2_COMPAT_MASK = 0xc000
@@ -39,7 +40,7 @@ compressors = [DummyCompressor,
 
 def getCompressor(comp_id):
     try:
-        return compressors[comp_id]()
+        return registry.get(compressors[comp_id])
     except Exception:
         raise Exception("Unknown compression: %d" % comp_id)
 
@@ -80,13 +81,12 @@ class GeneralINode(NamedTuple):
     hdr_crc_match: bool
 
     @classmethod
-    def unpack(cls, fd, endianess):
+    def unpack_from(cls, buf, offset, endianess):
         f = endianess + "HHII"
         s = calcsize(f)
-        cpos = fd.tell()
-        data = fd.read(s)
-        r = unpack(f, data)
-        return cls(r[0], InodeType(r[1]), r[2], r[3], mtd_crc(data[:-4]) == r[3])
+        r = unpack_from(f, buf, offset)
+        return cls(r[0], InodeType(r[1]), r[2], r[3],
+                   mtd_crc(buf[offset:offset + s - 4]) == r[3])
 
 
 class DirentINode(NamedTuple):
@@ -109,17 +109,25 @@ class DirentINode(NamedTuple):
     name_crc_match: bool
 
     @classmethod
-    def unpack(cls, fd, endianess):
+    def unpack_from(cls, buf, offset, endianess):
         f = endianess + "HH6IBBhII"
         s = calcsize(f)
-        data = fd.read(s)
-        r = unpack(f, data)
-        name = fd.read(r[8])
+        r = unpack_from(f, buf, offset)
+        name = bytes(buf[offset + s:offset + s + r[8]])
+        hdr_crc_match = mtd_crc(buf[offset:offset + 8]) == r[3]
+        node_crc_match = mtd_crc(buf[offset:offset + s - 8]) == r[11]
+        name_crc_match = mtd_crc(name) == r[12]
+        dtype = FTypes.DT_UNKNOWN
+        if node_crc_match and name_crc_match:
+            # Type and name are only decoded once the CRCs vouch for them
+            dtype = FTypes(r[9])
+            name = name.decode('utf-8')
+        else:
+            name = ''
         return cls(r[0], InodeType(r[1]), r[2], r[3], r[4],
-                   r[5], r[6], r[7], r[8], FTypes(r[9]),
-                   r[10], r[11], r[12], name.decode('utf-8'),
-                   mtd_crc(data[:8]) == r[3],
-                   True, mtd_crc(name) == r[12])
+                   r[5], r[6], r[7], r[8], dtype,
+                   r[10], r[11], r[12], name,
+                   hdr_crc_match, node_crc_match, name_crc_match)
 
 
 class RawINode(NamedTuple):
@@ -144,32 +152,76 @@ class RawINode(NamedTuple):
     flags: int      # See JFFS2_INO_FLAG_*
     data_crc: int   # CRC for the (compressed) data.
     node_crc: int   # CRC for the raw inode (excluding data)
-    data: bytes
+    data_offset: int    # Image offset of the (compressed) data.
     node_crc_match: bool
     data_crc_match: bool
 
     @classmethod
-    def unpack(cls, fd, endianess):
+    def unpack_from(cls, buf, offset, endianess, verify=True):
+        '''
+            With verify=False the data CRC is not checked and
+            data_crc_match is None.
+        '''
         f = endianess + "HH5IHH7IBBHII"
         s = calcsize(f)
-        data = fd.read(s)
-        r = unpack(f, data)
-        node_crc_match = mtd_crc(data[:-8]) == r[20]
+        r = unpack_from(f, buf, offset)
+        node_crc_match = mtd_crc(buf[offset:offset + s - 8]) == r[20]
         if node_crc_match:
             compr = Compression(r[16])
-            cnode_data = bytes(fd.read(r[14]))
-            data_crc_match = mtd_crc(cnode_data) == r[19]
-            node_data = None
-            if data_crc_match:
-                node_data = getCompressor(compr.value).decompress(cnode_data, r[15])
+            data_crc_match = None
+            if verify:
+                data_crc_match = mtd_crc(buf[offset + s:offset + s + r[14]]) == r[19]
             return cls(r[0], r[1], r[2], r[3], r[4],
                        r[5], r[6], r[7], r[8], r[9],
                        r[10], r[11], r[12], r[13], r[14],
                        r[15], compr, Compression(r[17]), r[18], r[19],
-                       r[20], node_data, node_crc_match,
+                       r[20], offset + s, node_crc_match,
                        data_crc_match)
 
 
+class DataNode(NamedTuple):
+    '''
+        Compact descriptor of a data carrying raw inode node. Payload is
+        decompressed only when a read touches it.
+    '''
+    offset: int     # Image offset of the (compressed) data.
+    csize: int
+    dsize: int
+    compr: int
+    foffset: int    # Offset of the data inside the file.
+    version: int
+    crc: int        # CRC of the (compressed) data.
+
+    @classmethod
+    def fromINode(cls, inode):
+        return cls(inode.data_offset, inode.csize, inode.dsize,
+                   inode.compr.value, inode.offset, inode.version, inode.data_crc)
+
+
+class SummaryINode(NamedTuple):
+    magic: int
+    nodetype: InodeType      # JFFS2_NODETYPE_SUMMARY
+    totlen: int
+    hdr_crc: int
+    sum_num: int             # number of summary records
+    cln_mkr: int             # cleanmarker size, 0 = no cleanmarker
+    padded: int              # sum of the size of padding nodes
+    sum_crc: int             # CRC of the records (up to the end of the erase block)
+    node_crc: int
+    hdr_crc_match: bool
+    node_crc_match: bool
+
+    @classmethod
+    def unpack_from(cls, buf, offset, endianess):
+        f = endianess + "HH7I"
+        s = calcsize(f)
+        r = unpack_from(f, buf, offset)
+        return cls(r[0], InodeType(r[1]), r[2], r[3], r[4],
+                   r[5], r[6], r[7], r[8],
+                   mtd_crc(buf[offset:offset + 8]) == r[3],
+                   mtd_crc(buf[offset:offset + s - 8]) == r[8])
+
+
 NODETYPES = {
     InodeType.JFFS2_NODETYPE_DIRENT: DirentINode,
     InodeType.JFFS2_NODETYPE_INODE: RawINode,
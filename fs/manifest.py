@@ -0,0 +1,64 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+import hashlib
+import json
+
+
+class ContentRun(NamedTuple):
+    '''
+        Files sharing the same stored data. chunks() yields the content,
+        position orders the runs as they are laid out in the image.
+    '''
+    position: int
+    size: int
+    paths: list
+    chunks: object
+
+
+class HashManifest(NamedTuple):
+    algorithm: str
+    entries: list       # (path, size, hexdigest), in on-disk order
+    runs: int
+    logical_bytes: int
+    unique_bytes: int
+
+    @property
+    def dedup_ratio(self):
+        if self.unique_bytes == 0:
+            return 1.0
+        return self.logical_bytes / self.unique_bytes
+
+    def write(self, f):
+        '''
+            JSON Lines manifest, one object per file.
+        '''
+        for path, size, digest in self.entries:
+            f.write(json.dumps({'path': path, 'size': size, self.algorithm: digest}) + '\n')
+
+
+def hashRuns(runs, algorithm='sha256', jobs=1):
+    '''
+        Decodes and hashes every run once, fanning out to jobs threads
+        (the decompressors release the GIL) while keeping on-disk order.
+    '''
+    runs = sorted(runs, key=lambda run: run.position)
+
+    def digest(run):
+        hasher = hashlib.new(algorithm)
+        for chunk in run.chunks():
+            hasher.update(chunk)
+        return hasher.hexdigest()
+
+    if jobs > 1:
+        with ThreadPoolExecutor(jobs, thread_name_prefix='imageio-hash') as executor:
+            digests = list(executor.map(digest, runs))
+    else:
+        digests = [digest(run) for run in runs]
+    entries = []
+    logical = 0
+    for run, hexdigest in zip(runs, digests):
+        for path in run.paths:
+            entries.append((path, run.size, hexdigest))
+            logical += run.size
+    return HashManifest(algorithm, entries, len(runs), logical,
+                        sum(run.size for run in runs))
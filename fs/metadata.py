@@ -0,0 +1,97 @@
+from array import array
+import csv
+
+
+COLUMNS = (('inode', 'Q'), ('parent', 'I'), ('type', 'H'), ('mode', 'I'), ('uid', 'I'),
+           ('gid', 'I'), ('mtime', 'Q'), ('size', 'Q'), ('csize', 'Q'), ('blocks', 'I'))
+
+
+class MetadataTable:
+    '''
+        Column-oriented metadata of every node of an image, row i is node
+        i of its PathIndex (breadth first, so parents come before their
+        children). size is the logical size, csize the bytes the content
+        takes in the image and blocks the number of stored data blocks or
+        nodes. Types use the d_type numbering of readdir(3).
+    '''
+    def __init__(self, paths):
+        self.paths = paths
+        for name, typecode in COLUMNS:
+            setattr(self, name, array(typecode))
+
+    def append(self, nid, inode, mode, uid, gid, mtime, size, csize, blocks):
+        self.inode.append(inode)
+        self.parent.append(self.paths.parent[nid])
+        self.type.append(self.paths.type[nid])
+        self.mode.append(mode)
+        self.uid.append(uid)
+        self.gid.append(gid)
+        self.mtime.append(mtime)
+        self.size.append(size)
+        self.csize.append(csize)
+        self.blocks.append(blocks)
+
+    def __len__(self):
+        return len(self.inode)
+
+    def path(self, row):
+        return self.paths.path(row)
+
+    def columns(self):
+        return ('path',) + tuple(name for name, typecode in COLUMNS)
+
+    def rows(self):
+        for row in range(len(self)):
+            yield (self.path(row),) + tuple(getattr(self, name)[row] for name, typecode in COLUMNS)
+
+    def writeCsv(self, f):
+        writer = csv.writer(f)
+        writer.writerow(self.columns())
+        writer.writerows(self.rows())
+
+    def toNumpy(self):
+        '''
+            NumPy structured array of the table, numpy is only needed here.
+        '''
+        import numpy
+        paths = [self.path(row) for row in range(len(self))]
+        dtype = [('path', 'U%d' % max(map(len, paths)))]
+        dtype += [(name, numpy.dtype(typecode)) for name, typecode in COLUMNS]
+        result = numpy.empty(len(self), dtype=dtype)
+        result['path'] = paths
+        for name, typecode in COLUMNS:
+            result[name] = numpy.frombuffer(getattr(self, name), dtype=typecode)
+        return result
+
+    def du(self, depth=None):
+        '''
+            (path, size, csize, files) per directory, totals include all
+            subdirectories. Hardlinked files are counted once. Computed in
+            a single bottom-up pass over the columns, no data is read.
+        '''
+        count = len(self)
+        size = array('Q', bytes(8 * count))
+        csize = array('Q', bytes(8 * count))
+        files = array('Q', bytes(8 * count))
+        seen = set()
+        isdir = self.paths.isdir
+        for row in range(count - 1, -1, -1):
+            if not isdir[row]:
+                if self.inode[row] in seen:
+                    continue
+                seen.add(self.inode[row])
+                files[row] = 1
+            size[row] += self.size[row]
+            csize[row] += self.csize[row]
+            if row:
+                parent = self.parent[row]
+                size[parent] += size[row]
+                csize[parent] += csize[row]
+                files[parent] += files[row]
+        result = []
+        for row in range(count):
+            if isdir[row]:
+                path = self.path(row)
+                if depth is None or path.count('/') - (path == '/') <= depth:
+                    result.append((path, size[row], csize[row], files[row]))
+        return result
@@ -0,0 +1,360 @@
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from fnmatch import fnmatchcase
+import errno
+import logging
+import os
+import sys
+
+
+log = logging.getLogger(__name__)
+
+PATH_MEMO_SIZE = 4096
+# Loops are detected exactly, this only bounds the recursion of long chains
+MAX_SYMLINKS = 256
+DT_LNK = 10
+
+# find(1) style type letters to the d_type numbering of readdir(3)
+FIND_TYPES = {'p': 1, 'c': 2, 'd': 4, 'b': 6, 'f': 8, 'l': 10, 's': 12}
+
+
+class NameTable:
+    '''
+        Read-only sequence of the names of an attached PathIndex, decoded
+        from a shared utf-8 blob on access.
+    '''
+    def __init__(self, offsets, blob):
+        self.offsets = offsets.cast('Q')
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return str(self.blob[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+
+
+class PathIndex:
+    '''
+        Directory hierarchy of an image shared by all backends. Nodes are
+        numbered breadth first, so the children of a directory occupy the
+        contiguous id range [first, first + count) and are sorted by name,
+        which allows a binary search per path component. Names are
+        interned and the per-node data lives in flat arrays, node types
+        use the d_type numbering of readdir(3). Resolved full paths are
+        memoized in a bounded dict (oldest entry evicted).
+    '''
+    def __init__(self):
+        self.names = []
+        self.parent = array('I')
+        self.inode = array('Q')
+        self.type = array('H')
+        self.isdir = array('B')
+        self.first = array('I')
+        self.count = array('I')
+        self.memo = OrderedDict()
+        self.links = {}
+        self.byName = None
+        self.sortedNames = None
+        self.reversedNames = None
+
+    @classmethod
+    def build(cls, root_inode, root_type, listDir):
+        '''
+            listDir(inode) returns the entries of a directory as
+            (name, inode, type, isdir) tuples.
+        '''
+        index = cls()
+        index._append('/', 0, root_inode, root_type, True)
+        seen = {root_inode}
+        nid = 0
+        while nid < len(index.names):
+            if index.isdir[nid]:
+                entries = sorted(listDir(index.inode[nid]))
+                index.first[nid] = len(index.names)
+                index.count[nid] = len(entries)
+                for name, inode, itype, isdir in entries:
+                    if isdir:
+                        if inode in seen:
+                            # Directory loop, keep the entry but do not descend
+                            isdir = False
+                        seen.add(inode)
+                    index._append(name, nid, inode, itype, isdir)
+            nid += 1
+        return index
+
+    def sections(self):
+        '''
+            Flat sections for fs.sharedindex, attach() maps them back.
+        '''
+        offsets = array('Q', [0])
+        blob = bytearray()
+        for name in self.names:
+            blob += name.encode('utf-8')
+            offsets.append(len(blob))
+        result = {'paths.names': offsets.tobytes(), 'paths.blob': bytes(blob)}
+        for column in ('parent', 'inode', 'type', 'isdir', 'first', 'count'):
+            result['paths.' + column] = getattr(self, column).tobytes()
+        return result
+
+    @classmethod
+    def attach(cls, sections):
+        index = cls()
+        index.names = NameTable(sections['paths.names'], sections['paths.blob'])
+        for column in ('parent', 'inode', 'type', 'isdir', 'first', 'count'):
+            setattr(index, column, sections['paths.' + column].cast(getattr(index, column).typecode))
+        return index
+
+    def _append(self, name, parent, inode, itype, isdir):
+        self.names.append(sys.intern(name))
+        self.parent.append(parent)
+        self.inode.append(inode)
+        self.type.append(itype)
+        self.isdir.append(1 if isdir else 0)
+        self.first.append(0)
+        self.count.append(0)
+
+    def __len__(self):
+        return len(self.names)
+
+    def child(self, nid, name):
+        lo = self.first[nid]
+        hi = lo + self.count[nid]
+        i = bisect_left(self.names, name, lo, hi)
+        if i < hi and self.names[i] == name:
+            return i
+        return None
+
+    def children(self, nid):
+        return range(self.first[nid], self.first[nid] + self.count[nid])
+
+    def lookup(self, path):
+        nid = self.memo.get(path)
+        if nid is not None:
+            return nid
+        nid = 0
+        names = self.names
+        first = self.first
+        count = self.count
+        for name in path.split('/'):
+            if name:
+                lo = first[nid]
+                hi = lo + count[nid]
+                nid = bisect_left(names, name, lo, hi)
+                if nid >= hi or names[nid] != name:
+                    return None
+        memo = self.memo
+        if len(memo) >= PATH_MEMO_SIZE:
+            try:
+                memo.popitem(last=False)
+            except KeyError:
+                pass
+        memo[path] = nid
+        return nid
+
+    def path(self, nid):
+        parts = []
+        while nid:
+            parts.append(self.names[nid])
+            nid = self.parent[nid]
+        return '/' + '/'.join(reversed(parts))
+
+    def listPath(self, path):
+        '''
+            Names in a directory, or the name itself for other nodes.
+        '''
+        nid = self.lookup(path)
+        if nid is None:
+            return []
+        if self.isdir[nid]:
+            return [self.names[i] for i in self.children(nid)]
+        return [self.names[nid]]
+
+    def entries(self, path, offset=0):
+        '''
+            (name, inode, type) of the directory entries from offset on.
+        '''
+        nid = self.lookup(path)
+        if nid is None or not self.isdir[nid]:
+            return []
+        start = self.first[nid]
+        return [(self.names[i], self.inode[i], self.type[i])
+                for i in range(start + offset, start + self.count[nid])]
+
+    def _walkParts(self, nid, parts, readLink, follow_last, active, strict=True):
+        last = len(parts) - 1
+        while last >= 0 and parts[last] in ('', '.'):
+            last -= 1
+        for pos, name in enumerate(parts):
+            # Any component, also '.', '..' or a trailing slash, needs a directory
+            if not self.isdir[nid]:
+                if not strict:
+                    return None
+                raise NotADirectoryError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), self.path(nid))
+            if name == '' or name == '.':
+                continue
+            if name == '..':
+                nid = self.parent[nid]
+                continue
+            nid = self.child(nid, name)
+            if nid is None:
+                return None
+            if self.type[nid] == DT_LNK and (pos < last or follow_last):
+                nid = self._followLink(nid, readLink, active)
+                if nid is None:
+                    return None
+        return nid
+
+    def _followLink(self, nid, readLink, active):
+        '''
+            Node a symlink finally points at. Resolved links are memoized
+            per symlink node, so shared prefixes like /bin -> usr/bin are
+            followed only once. active holds the links being followed.
+            A target continuing past a file is dangling like a missing
+            one, only the caller's own path raises NotADirectoryError.
+        '''
+        result = self.links.get(nid)
+        if result is not None:
+            return result
+        if nid in active or len(active) >= MAX_SYMLINKS:
+            log.debug("[FollowLink] Symlink loop at %s" % self.path(nid))
+            return None
+        target = readLink(nid)
+        if not target:
+            return None
+        active.add(nid)
+        start = 0 if target.startswith('/') else self.parent[nid]
+        try:
+            result = self._walkParts(start, target.split('/'), readLink, True, active, False)
+        finally:
+            active.discard(nid)
+        if result is not None:
+            self.links[nid] = result
+        return result
+
+    def resolve(self, path, readLink, follow_symlinks=True):
+        '''
+            Node of path with every symlink in it followed, the last one
+            only with follow_symlinks. readLink(nid) returns the target
+            of a symlink node. Absolute targets start at the image root
+            and '..' stops there. None for missing paths and loops,
+            NotADirectoryError when path continues past a node which is
+            not a directory (a symlink target doing so is dangling).
+        '''
+        # A trailing slash always follows the last component
+        follow = follow_symlinks or path.endswith('/')
+        return self._walkParts(0, path.split('/'), readLink, follow, set())
+
+    def _join(self, path, name):
+        return path.rstrip('/') + '/' + name
+
+    def walk(self, top='/'):
+        '''
+            Top-down (dirpath, dirnames, filenames) tuples like os.walk,
+            removing names from dirnames prunes the walk.
+        '''
+        nid = self.lookup(top)
+        if nid is None or not self.isdir[nid]:
+            return
+        stack = [(nid, top)]
+        while stack:
+            nid, path = stack.pop()
+            dirs = []
+            files = []
+            for i in self.children(nid):
+                (dirs if self.isdir[i] else files).append(self.names[i])
+            yield path, dirs, files
+            for name in reversed(dirs):
+                i = self.child(nid, name)
+                if i is not None:
+                    stack.append((i, self._join(path, name)))
+
+    def _buildNameIndex(self):
+        '''
+            Inverted name -> node ids index, plus the distinct names sorted
+            forwards and reversed for prefix and suffix queries. Built once
+            on first use.
+        '''
+        byName = {}
+        names = self.names
+        for nid in range(1, len(names)):
+            byName.setdefault(names[nid], array('I')).append(nid)
+        self.sortedNames = sorted(byName)
+        self.reversedNames = sorted(name[::-1] for name in byName)
+        self.byName = byName
+
+    def _matchNames(self, pattern):
+        if self.byName is None:
+            self._buildNameIndex()
+        magic = [i for i, c in enumerate(pattern) if c in '*?[']
+        if not magic:
+            return [pattern] if pattern in self.byName else []
+        if magic == [0] and pattern[0] == '*':
+            return self._withPrefix(self.reversedNames, pattern[:0:-1], True)
+        if magic == [len(pattern) - 1] and pattern[-1] == '*':
+            return self._withPrefix(self.sortedNames, pattern[:-1], False)
+        return [name for name in self.sortedNames if fnmatchcase(name, pattern)]
+
+    def _withPrefix(self, names, prefix, reverse):
+        result = []
+        for i in range(bisect_left(names, prefix), len(names)):
+            if not names[i].startswith(prefix):
+                break
+            result.append(names[i][::-1] if reverse else names[i])
+        return result
+
+    def find(self, name=None, type=None):
+        '''
+            Node ids matching a name (exact or shell pattern) and a find(1)
+            type letter, in breadth first order.
+        '''
+        if name is None:
+            nids = range(1, len(self.names))
+        else:
+            nids = sorted(nid for match in self._matchNames(name) for nid in self.byName[match])
+        if type is None:
+            return list(nids)
+        dtype = FIND_TYPES[type]
+        itype = self.type
+        return [nid for nid in nids if itype[nid] == dtype]
+
+    def descendants(self, nid, dirs_only=False):
+        '''
+            Node ids of nid and every node below it in breadth first
+            order, only the directories with dirs_only.
+        '''
+        result = [nid]
+        pos = 0
+        while pos < len(result):
+            for i in self.children(result[pos]):
+                if self.isdir[i] or not dirs_only:
+                    result.append(i)
+            pos += 1
+        return result
+
+    def glob(self, pattern):
+        '''
+            Absolute paths matching a shell pattern, '**' matches any
+            number of directories.
+        '''
+        parts = [part for part in pattern.split('/') if part]
+        if len(parts) == 2 and parts[0] == '**' and '**' not in parts[1]:
+            return [self.path(nid) for nid in self.find(parts[1])]
+        nids = [0]
+        for pos, part in enumerate(parts):
+            last = pos == len(parts) - 1
+            matched = []
+            for nid in nids:
+                if not self.isdir[nid]:
+                    continue
+                if part == '**':
+                    matched.extend(self.descendants(nid, not last))
+                elif any(c in part for c in '*?['):
+                    matched.extend(i for i in self.children(nid) if fnmatchcase(self.names[i], part))
+                else:
+                    i = self.child(nid, part)
+                    if i is not None:
+                        matched.append(i)
+            nids = list(dict.fromkeys(matched))
+        return [self.path(nid) for nid in nids]
@@ -0,0 +1,148 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import logging
+import threading
+import fs
+from fs.cache import LRUCache, DEFAULT_CACHE_SIZE
+from fs.source import openSource
+
+
+log = logging.getLogger(__name__)
+
+# Sources holding a descriptor (a mapped image file, a compressed image)
+DEFAULT_MAX_OPEN = 64
+
+
+class ImagePool:
+    '''
+        Keeps any number of images open at once. Parsed images and open
+        descriptors are two separate LRUs: at most max_open sources hold a
+        descriptor, the least recently used ones are suspended and reopen
+        on their next read. With max_images only that many parsed indexes
+        are kept, evicted images are parsed again on their next use. All
+        images share one cache budget for decompressed data.
+
+        Images used from several threads should be taken with use(), an
+        image in use is never suspended nor evicted.
+    '''
+    def __init__(self, max_open=DEFAULT_MAX_OPEN, max_images=None, cache_size=DEFAULT_CACHE_SIZE,
+                 loglevel=logging.INFO, options=None):
+        self.maxOpen = max_open
+        self.maxImages = max_images
+        self.cache = LRUCache(cache_size)
+        self.loglevel = loglevel
+        self.options = options
+        self.images = OrderedDict()     # path -> image
+        self.sources = OrderedDict()    # source -> path, for sources holding a descriptor
+        self.pins = {}
+        self.lock = threading.RLock()
+
+    def _load(self, path):
+        source = openSource(path, self.cache)
+        source.tracker = self
+        # Descriptors are counted from their next (re)open on, sources
+        # which cannot release theirs never report one
+        source.suspend()
+        image = fs.openImage(source, self.loglevel, self.cache, self.options)
+        if image is None:
+            self._forget(source)
+            raise ValueError("Unsupported image type: %s" % path)
+        if source in self.sources:
+            self.sources[source] = path
+        return image
+
+    def get(self, path):
+        '''
+            Image of path, parsed on first use.
+        '''
+        with self.lock:
+            image = self.images.get(path)
+            if image is None:
+                image = self._load(path)
+                self.images[path] = image
+                self._trim()
+            else:
+                self.images.move_to_end(path)
+            if image.source in self.sources:
+                self.sources.move_to_end(image.source)
+            return image
+
+    @contextmanager
+    def use(self, path):
+        '''
+            Image of path, kept open and parsed until the block ends.
+        '''
+        with self.lock:
+            image = self.get(path)
+            self.pins[path] = self.pins.get(path, 0) + 1
+        try:
+            yield image
+        finally:
+            with self.lock:
+                self.pins[path] -= 1
+                if not self.pins[path]:
+                    del self.pins[path]
+
+    def _busy(self, path):
+        if path in self.pins:
+            return True
+        # A background CRC verification still reads the image
+        verifier = getattr(self.images.get(path), 'verifier', None)
+        return verifier is not None and verifier.is_alive()
+
+    def opened(self, source):
+        '''
+            Called by a source when it opens a descriptor, suspends the
+            least recently used other sources over the limit.
+        '''
+        with self.lock:
+            self.sources[source] = self.sources.pop(source, None)
+            for other, path in list(self.sources.items()):
+                if len(self.sources) <= self.maxOpen:
+                    break
+                if other is not source and not self._busy(path) and other.suspend():
+                    del self.sources[other]
+
+    def _forget(self, source):
+        with self.lock:
+            self.sources.pop(source, None)
+        source.tracker = None
+        source.close()
+
+    def evict(self, path=None):
+        '''
+            Drops the parsed index of path (default: the least recently
+            used image not in use), its cached data and its descriptors.
+            Returns the evicted path, None when nothing could be evicted.
+        '''
+        with self.lock:
+            if path is None:
+                path = next((item for item in self.images if not self._busy(item)), None)
+            if path is None or path not in self.images or self._busy(path):
+                return None
+            image = self.images.pop(path)
+            self.cache.purge(image.cacheTag)
+            tag = getattr(image.source, 'cacheTag', None)
+            if tag is not None:
+                self.cache.purge(tag)
+            self._forget(image.source)
+            log.debug("[Evict] %s" % path)
+            return path
+
+    def _trim(self):
+        while self.maxImages is not None and len(self.images) > self.maxImages:
+            if self.evict() is None:
+                break
+
+    def stats(self):
+        with self.lock:
+            return {'images': len(self.images),
+                    'open': len(self.sources),
+                    'cache': self.cache.stats()}
+
+    def close(self):
+        with self.lock:
+            while self.images:
+                path, image = self.images.popitem(last=False)
+                self._forget(image.source)
+            self.cache.clear()
@@ -0,0 +1,154 @@
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+# Bytes hashed (with the size) to recognize an image across mounts
+IDENTITY_SIZE = 64 * 1024
+# Keeps profile files small, later blocks are not recorded
+MAX_PROFILE_BLOCKS = 64 * 1024
+# Warming waits while the last foreground read is more recent than this
+IDLE_DELAY = 0.05
+
+
+def imageIdentity(image):
+    digest = hashlib.sha1(str(len(image.source)).encode('ascii'))
+    digest.update(image.source.pread(0, IDENTITY_SIZE))
+    return digest.hexdigest()
+
+
+class AccessProfile:
+    '''
+        Blocks of every file read during a session, files and blocks in
+        order of first access. Saved as JSON with runs of consecutive
+        blocks as [first, count] pairs.
+    '''
+    def __init__(self, identity, block_size):
+        self.identity = identity
+        self.blockSize = block_size
+        self.files = OrderedDict()     # path -> ordered dict of block numbers
+        self.count = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def forImage(cls, image):
+        return cls(imageIdentity(image), image.getStatFs()['st_blksize'])
+
+    def record(self, path, offset, length):
+        if length <= 0 or self.count >= MAX_PROFILE_BLOCKS:
+            return
+        bs = self.blockSize
+        with self.lock:
+            blocks = self.files.get(path)
+            if blocks is None:
+                blocks = self.files[path] = OrderedDict()
+            for block in range(offset // bs, (offset + length - 1) // bs + 1):
+                if block not in blocks:
+                    blocks[block] = None
+                    self.count += 1
+
+    def blocks(self):
+        '''
+            (path, block number) pairs in recorded order.
+        '''
+        for path, blocks in list(self.files.items()):
+            for block in list(blocks):
+                yield path, block
+
+    def __len__(self):
+        return self.count
+
+    def save(self, path):
+        files = []
+        with self.lock:
+            for name, blocks in self.files.items():
+                runs = []
+                for block in blocks:
+                    if runs and runs[-1][0] + runs[-1][1] == block:
+                        runs[-1][1] += 1
+                    else:
+                        runs.append([block, 1])
+                files.append([name, runs])
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'identity': self.identity, 'block_size': self.blockSize, 'files': files}, f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, identity):
+        '''
+            Profile saved at path, None when there is none for identity.
+        '''
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get('identity') != identity:
+            return None
+        profile = cls(identity, data['block_size'])
+        for name, runs in data['files']:
+            blocks = profile.files[name] = OrderedDict()
+            for first, count in runs:
+                for block in range(first, first + count):
+                    blocks[block] = None
+            profile.count += len(blocks)
+        return profile
+
+
+def profilePath(directory, identity):
+    return os.path.join(directory, identity + '.json')
+
+
+class CacheWarmer(threading.Thread):
+    '''
+        Replays a profile in the background, decoding the recorded blocks
+        into the image cache. Waits while foreground reads are running
+        (see foreground()) and stops once the cache budget is reached, so
+        warming never evicts data that was actually asked for.
+    '''
+    def __init__(self, image, profile, idle=IDLE_DELAY):
+        threading.Thread.__init__(self, name='imageio-warmer', daemon=True)
+        self.image = image
+        self.profile = profile
+        self.idle = idle
+        self.lastForeground = 0
+        self.warmed = 0
+        self.stopped = threading.Event()
+
+    def foreground(self):
+        self.lastForeground = time.monotonic()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _lowerPriority(self):
+        try:
+            # Linux applies the nice value of a thread id to that thread only
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError) as e:
+            log.debug("[Warmer] Can't lower priority: %s" % e)
+
+    def run(self):
+        self._lowerPriority()
+        cache = self.image.cache
+        bs = self.profile.blockSize
+        start = time.monotonic()
+        for path, block in self.profile.blocks():
+            while not self.stopped.is_set() and time.monotonic() - self.lastForeground < self.idle:
+                self.stopped.wait(self.idle)
+            if self.stopped.is_set():
+                break
+            if cache.size + bs > cache.maxbytes:
+                log.debug("[Warmer] Cache budget reached")
+                break
+            self.image.readRange(path, block * bs, bs)
+            self.warmed += 1
+        log.debug("[Warmer] %d of %d blocks warmed in %.2fs" %
+                  (self.warmed, len(self.profile), time.monotonic() - start))
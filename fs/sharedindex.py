@@ -0,0 +1,199 @@
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from struct import pack, unpack_from, calcsize
+import mmap
+import pickle
+
+
+INDEX_MAGIC = b'IMGIDX01'
+SECTION_HEADER = "<32sQQ"
+RECORD_MEMO_SIZE = 4096
+
+
+def packSections(sections):
+    '''
+        Flat buffer holding named byte sections, 8 byte aligned so that
+        array sections can be cast in place.
+    '''
+    header = calcsize(SECTION_HEADER)
+    offset = len(INDEX_MAGIC) + 8 + header * len(sections)
+    table = []
+    data = []
+    for name, blob in sections.items():
+        offset += -offset % 8
+        table.append(pack(SECTION_HEADER, name.encode('ascii'), offset, len(blob)))
+        data.append(blob)
+        offset += len(blob)
+    out = bytearray(INDEX_MAGIC + pack("<Q", len(sections)) + b''.join(table))
+    for blob in data:
+        out += bytes(-len(out) % 8)
+        out += blob
+    return bytes(out)
+
+
+def unpackSections(buf):
+    '''
+        name -> memoryview of every section, nothing is copied.
+    '''
+    view = memoryview(buf)
+    if bytes(view[:len(INDEX_MAGIC)]) != INDEX_MAGIC:
+        raise ValueError("Not an image index")
+    count = unpack_from("<Q", view, len(INDEX_MAGIC))[0]
+    pos = len(INDEX_MAGIC) + 8
+    sections = {}
+    for i in range(count):
+        name, offset, length = unpack_from(SECTION_HEADER, view, pos)
+        sections[name.rstrip(b'\0').decode('ascii')] = view[offset:offset + length]
+        pos += calcsize(SECTION_HEADER)
+    return sections
+
+
+def packRecords(records):
+    '''
+        (offsets, blob) sections of pickled records, None is stored empty.
+    '''
+    offsets = array('Q', [0])
+    blob = bytearray()
+    for record in records:
+        if record is not None:
+            blob += pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        offsets.append(len(blob))
+    return offsets.tobytes(), bytes(blob)
+
+
+class RecordTable:
+    '''
+        Read-only sequence over records packed by packRecords. Records are
+        unpickled on access, the most recent ones are kept in a bounded
+        per-process memo (oldest entry evicted).
+    '''
+    def __init__(self, offsets, blob):
+        self.offsets = offsets.cast('Q')
+        self.blob = blob
+        self.memo = OrderedDict()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        record = self.memo.get(i)
+        if record is None:
+            start = self.offsets[i]
+            end = self.offsets[i + 1]
+            if start == end:
+                return None
+            record = pickle.loads(self.blob[start:end])
+            if len(self.memo) >= RECORD_MEMO_SIZE:
+                self.memo.popitem(last=False)
+            self.memo[i] = record
+        return record
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class RecordMap:
+    '''
+        Read-only mapping from sorted integer keys to packed records.
+    '''
+    def __init__(self, keys, offsets, blob):
+        self.keys = keys.cast('Q')
+        self.records = RecordTable(offsets, blob)
+
+    def _find(self, key):
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        return None
+
+    def get(self, key, default=None):
+        i = self._find(key)
+        return default if i is None else self.records[i]
+
+    def __getitem__(self, key):
+        i = self._find(key)
+        if i is None:
+            raise KeyError(key)
+        return self.records[i]
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def items(self):
+        for i, key in enumerate(self.keys):
+            yield key, self.records[i]
+
+    def values(self):
+        return iter(self.records)
+
+
+def packMap(mapping):
+    keys = array('Q', sorted(mapping))
+    offsets, blob = packRecords(mapping[key] for key in keys)
+    return keys.tobytes(), offsets, blob
+
+
+def exportIndex(image):
+    '''
+        Parsed metadata of an image as one flat read-only buffer.
+    '''
+    sections = {'class': type(image).__name__.encode('ascii')}
+    sections.update(image.indexSections())
+    return packSections(sections)
+
+
+def attachIndex(source, buf, cache=None):
+    '''
+        Image on top of a buffer made by exportIndex, without parsing the
+        image again. buf is only referenced, so it can be shared memory or
+        an mmap'd file used by several processes at once.
+    '''
+    import fs
+    sections = unpackSections(buf)
+    name = bytes(sections['class']).decode('ascii')
+    for fscls in fs.supported_filesystems:
+        if fscls.__name__ == name:
+            return fscls.fromIndex(source, sections, cache)
+    raise ValueError("Unknown image class in index: %s" % name)
+
+
+def shareIndex(image):
+    '''
+        Copies the index of image into a new shared memory block. Workers
+        attach with attachShared(source, shm.name), the creator unlinks it.
+    '''
+    from multiprocessing import shared_memory
+    data = exportIndex(image)
+    shm = shared_memory.SharedMemory(create=True, size=len(data))
+    shm.buf[:len(data)] = data
+    return shm
+
+
+def attachShared(source, name, cache=None):
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=name)
+    image = attachIndex(source, shm.buf, cache)
+    # The mapping has to live as long as the image
+    image.indexBuffer = shm
+    return image
+
+
+def saveIndex(image, path):
+    with open(path, 'wb') as f:
+        f.write(exportIndex(image))
+
+
+def loadIndex(source, path, cache=None):
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    image = attachIndex(source, mm, cache)
+    image.indexBuffer = mm
+    return image
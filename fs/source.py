@@ -0,0 +1,564 @@
+from bisect import bisect_right
+from urllib.parse import urlsplit
+import http.client
+import logging
+import lzma
+import mmap
+import os
+import threading
+import zlib
+from fs.cache import LRUCache, newTag
+
+
+log = logging.getLogger(__name__)
+
+SOURCE_CHUNK_SIZE = 128 * 1024
+SOURCE_CACHE_SIZE = 32 * 1024 * 1024
+# Distance between the decompressor snapshots of a gzip image
+CHECKPOINT_SPAN = 1024 * 1024
+READ_SIZE = 64 * 1024
+
+GZIP_MAGIC = b'\x1f\x8b'
+XZ_MAGIC = b'\xfd7zXZ\x00'
+
+
+class ByteSource:
+    '''
+        Read-only random access to the bytes of an image. Slicing returns
+        bytes like an mmap would, open() gives a file like cursor.
+    '''
+    path = None
+    size = 0
+    data = None
+    # Notified through opened(source) whenever a descriptor is (re)opened
+    tracker = None
+
+    def pread(self, offset, length):
+        raise NotImplementedError
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, item):
+        start, stop, step = item.indices(self.size)
+        return self.pread(start, max(0, stop - start))
+
+    def buffer(self):
+        '''
+            The whole image as a buffer supporting find() and the buffer
+            protocol, for scanners that have to look at every byte. Read
+            once and kept.
+        '''
+        if self.data is None:
+            self.data = self.pread(0, self.size)
+        return self.data
+
+    def open(self):
+        return SourceFile(self)
+
+    def suspend(self):
+        '''
+            Releases the OS descriptors of the source, the next read opens
+            them again. Returns False when they are still held.
+        '''
+        return False
+
+    def _reopened(self):
+        if self.tracker is not None:
+            self.tracker.opened(self)
+
+    def close(self):
+        pass
+
+
+class SourceFile:
+    def __init__(self, source):
+        self.source = source
+        self.pos = 0
+
+    def seek(self, pos):
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, length):
+        data = self.source.pread(self.pos, length)
+        self.pos += len(data)
+        return data
+
+
+class ReopenableFile:
+    '''
+        Descriptor of a file opened on first use, so that it can be closed
+        by suspend() and opened again transparently.
+    '''
+    def __init__(self, path, source):
+        self.path = path
+        self.source = source
+        self.fd = None
+        self.lock = threading.Lock()
+
+    def fileno(self):
+        fd = self.fd
+        if fd is None:
+            opened = False
+            with self.lock:
+                if self.fd is None:
+                    self.fd = os.open(self.path, os.O_RDONLY)
+                    opened = True
+                fd = self.fd
+            if opened:
+                self.source._reopened()
+        return fd
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+        return True
+
+
+class FileSource(ByteSource):
+    '''
+        Plain image file, mapped into memory. The page cache is the
+        read cache, so nothing is cached on top of it. Only the mapping
+        holds a descriptor, suspend() unmaps the file until the next read.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.mm = None
+        self.size = len(self._map())
+
+    def _map(self):
+        mm = self.mm
+        if mm is None:
+            opened = False
+            with self.lock:
+                if self.mm is None:
+                    with open(self.path, 'rb') as f:
+                        self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    opened = True
+                mm = self.mm
+            if opened:
+                self._reopened()
+        return mm
+
+    def pread(self, offset, length):
+        return self._map()[offset:offset + length]
+
+    def __getitem__(self, item):
+        return self._map()[item]
+
+    def buffer(self):
+        return self._map()
+
+    def suspend(self):
+        with self.lock:
+            if self.mm is None:
+                return True
+            try:
+                self.mm.close()
+            except BufferError:
+                # Views of the mapping are still alive
+                return False
+            self.mm = None
+            return True
+
+    def close(self):
+        self.suspend()
+
+
+class CachedSource(ByteSource):
+    '''
+        Source reading whole aligned chunks through _fetch(offset, length),
+        kept in an LRU cache. Missing neighbouring chunks of one request are
+        fetched together, and threads asking for a chunk that is already
+        being fetched wait for it instead of fetching it again.
+    '''
+    def __init__(self, chunk_size=SOURCE_CHUNK_SIZE, cache_size=SOURCE_CACHE_SIZE, cache=None):
+        self.chunkSize = chunk_size
+        # A shared cache is split between sources by the tag in the keys
+        self.cache = cache if cache is not None else LRUCache(cache_size)
+        self.cacheTag = newTag()
+        self.lock = threading.Lock()
+        self.inflight = {}
+
+    def _fetch(self, offset, length):
+        raise NotImplementedError
+
+    def _store(self, chunk, data):
+        key = (self.cacheTag, chunk)
+        if key not in self.cache:
+            self.cache.put(key, data)
+
+    def _collect(self, pieces, offset, length):
+        '''
+            Bytes [offset, offset + length) out of consecutive decoded
+            (output offset, data) pieces. Every whole chunk passed on the
+            way is cached as well, so decoding is not repeated for them.
+        '''
+        end = offset + length
+        cs = self.chunkSize
+        out = bytearray()
+        pending = bytearray()
+        pending_start = None
+        for uoffset, data in pieces:
+            lo = max(offset, uoffset)
+            hi = min(end, uoffset + len(data))
+            if hi > lo:
+                out += data[lo - uoffset:hi - uoffset]
+            if pending_start is None:
+                pending_start = uoffset
+            pending += data
+            skip = -pending_start % cs
+            while len(pending) - skip >= cs:
+                self._store((pending_start + skip) // cs, bytes(pending[skip:skip + cs]))
+                skip += cs
+            skip = min(skip, len(pending))
+            del pending[:skip]
+            pending_start += skip
+            if uoffset + len(data) >= end:
+                break
+        return bytes(out)
+
+    def _load(self, first, last):
+        '''
+            Fetches chunks [first, last] in one request and caches them.
+        '''
+        cs = self.chunkSize
+        data = self._fetch(first * cs, min(self.size, (last + 1) * cs) - first * cs)
+        result = {}
+        for chunk in range(first, last + 1):
+            result[chunk] = data[(chunk - first) * cs:(chunk - first + 1) * cs]
+            self._store(chunk, result[chunk])
+        return result
+
+    def _loadMissing(self, missing):
+        own = []
+        waits = []
+        with self.lock:
+            for chunk in missing:
+                event = self.inflight.get(chunk)
+                if event is None:
+                    self.inflight[chunk] = threading.Event()
+                    own.append(chunk)
+                else:
+                    waits.append((chunk, event))
+        result = {}
+        try:
+            start = 0
+            for pos in range(1, len(own) + 1):
+                if pos == len(own) or own[pos] != own[pos - 1] + 1:
+                    result.update(self._load(own[start], own[pos - 1]))
+                    start = pos
+        finally:
+            with self.lock:
+                for chunk in own:
+                    self.inflight.pop(chunk).set()
+        for chunk, event in waits:
+            event.wait()
+            data = self.cache.get((self.cacheTag, chunk))
+            if data is None:
+                # The other fetch failed or the chunk was evicted already
+                data = self._load(chunk, chunk)[chunk]
+            result[chunk] = data
+        return result
+
+    def pread(self, offset, length):
+        end = min(offset + length, self.size)
+        if offset >= end:
+            return b''
+        cs = self.chunkSize
+        first = offset // cs
+        last = (end - 1) // cs
+        chunks = {}
+        missing = []
+        for chunk in range(first, last + 1):
+            data = self.cache.get((self.cacheTag, chunk))
+            if data is None:
+                missing.append(chunk)
+            else:
+                chunks[chunk] = data
+        if missing:
+            chunks.update(self._loadMissing(missing))
+        data = b''.join(chunks[chunk] for chunk in range(first, last + 1))
+        skip = offset - first * cs
+        return data[skip:skip + end - offset]
+
+
+class GzipSource(CachedSource):
+    '''
+        gzip compressed image. One pass at open records a snapshot of the
+        inflater every CHECKPOINT_SPAN output bytes, reads resume from the
+        closest snapshot before them.
+    '''
+    def __init__(self, path, chunk_size=SOURCE_CHUNK_SIZE, cache_size=SOURCE_CACHE_SIZE,
+                 span=CHECKPOINT_SPAN, cache=None):
+        CachedSource.__init__(self, chunk_size, cache_size, cache)
+        self.f = ReopenableFile(path, self)
+        self.marks = [0]
+        self.checkpoints = [(0, None)]
+        end = 0
+        for coffset, d, uoffset, data in self._inflate(0, None, 0):
+            end = uoffset + len(data)
+            if end >= self.marks[-1] + span:
+                self.marks.append(end)
+                self.checkpoints.append((coffset, d.copy()))
+        self.size = end
+        log.debug("[GzipSource] %d bytes, %d checkpoints" % (self.size, len(self.marks)))
+
+    def _inflate(self, coffset, d, uoffset):
+        '''
+            Yields (input offset, inflater, output offset, data) after
+            every piece of input, continuing across gzip members.
+        '''
+        d = d or zlib.decompressobj(zlib.MAX_WBITS | 16)
+        while True:
+            cdata = os.pread(self.f.fileno(), READ_SIZE, coffset)
+            if not cdata:
+                return
+            coffset += len(cdata)
+            data = d.decompress(cdata)
+            while d.eof and d.unused_data.strip(b'\0'):
+                rest = d.unused_data
+                d = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                data += d.decompress(rest)
+            yield coffset, d, uoffset, data
+            uoffset += len(data)
+
+    def _fetch(self, offset, length):
+        i = bisect_right(self.marks, offset) - 1
+        coffset, d = self.checkpoints[i]
+        pieces = ((uoffset, data) for coffset, d, uoffset, data
+                  in self._inflate(coffset, d.copy() if d else None, self.marks[i]))
+        return self._collect(pieces, offset, length)
+
+    def suspend(self):
+        return self.f.close()
+
+    def close(self):
+        self.f.close()
+
+
+class XzSource(CachedSource):
+    '''
+        xz compressed image. The block index of the stream is the
+        checkpoint index, a read decodes only the blocks it covers, from
+        the block start in READ_SIZE pieces up to its end, caching every
+        whole chunk on the way. The decoder of the last read is kept, so
+        reads further on in the same block (a single block image made by
+        plain xz) continue from there. Images without a usable index
+        (several streams, padding) are decoded from the start.
+    '''
+    def __init__(self, path, chunk_size=SOURCE_CHUNK_SIZE, cache_size=SOURCE_CACHE_SIZE, cache=None):
+        CachedSource.__init__(self, chunk_size, cache_size, cache)
+        self.f = ReopenableFile(path, self)
+        self.resume = None
+        self.blocks = self._readIndex()
+        if self.blocks is None:
+            self.blocks = []
+            self.size = sum(len(data) for uoffset, data in self._decodeStream())
+        else:
+            self.size = self.blocks[-1][0] + self.blocks[-1][2] if self.blocks else 0
+        self.marks = [block[0] for block in self.blocks]
+        log.debug("[XzSource] %d bytes, %d blocks" % (self.size, len(self.blocks)))
+
+    def _pread(self, offset, length):
+        return os.pread(self.f.fileno(), length, offset)
+
+    @staticmethod
+    def _varint(data, pos):
+        value = 0
+        shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            value |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                return value, pos
+
+    def _readIndex(self):
+        '''
+            [(output offset, block offset, output size, block size)] from
+            the index of a single stream file, None if the file is not one.
+        '''
+        size = os.fstat(self.f.fileno()).st_size
+        self.streamHeader = self._pread(0, 12)
+        footer = self._pread(size - 12, 12)
+        if len(footer) != 12 or footer[10:] != b'YZ' or self.streamHeader[:6] != XZ_MAGIC:
+            return None
+        backward = (int.from_bytes(footer[4:8], 'little') + 1) * 4
+        index_start = size - 12 - backward
+        index = self._pread(index_start, backward)
+        if not index or index[0] != 0:
+            return None
+        count, pos = self._varint(index, 1)
+        blocks = []
+        uoffset = 0
+        coffset = 12
+        for i in range(count):
+            unpadded, pos = self._varint(index, pos)
+            usize, pos = self._varint(index, pos)
+            blocks.append((uoffset, coffset, usize, (unpadded + 3) & ~3))
+            uoffset += usize
+            coffset += (unpadded + 3) & ~3
+        if coffset != index_start:
+            # Stream padding or several streams
+            return None
+        return blocks
+
+    def _blockData(self, i):
+        '''
+            (output offset, data) pieces of block i, at most READ_SIZE
+            bytes each. The block is decoded as the only block of a
+            stream behind the header of the image stream, so its check is
+            verified and the decoder never sees an index.
+        '''
+        uoffset, coffset, usize, csize = self.blocks[i]
+        end = coffset + csize
+        d = lzma.LZMADecompressor(lzma.FORMAT_XZ)
+        d.decompress(self.streamHeader)
+        while True:
+            if d.needs_input:
+                if coffset >= end:
+                    break
+                cdata = self._pread(coffset, min(READ_SIZE, end - coffset))
+                if not cdata:
+                    break
+                coffset += len(cdata)
+                data = d.decompress(cdata, READ_SIZE)
+            else:
+                data = d.decompress(b'', READ_SIZE)
+            if data:
+                yield uoffset, data
+                uoffset += len(data)
+        if uoffset != self.blocks[i][0] + usize:
+            raise lzma.LZMAError("xz block @ %d decoded to %d bytes, expected %d" %
+                                 (self.blocks[i][1], uoffset - self.blocks[i][0], usize))
+
+    def _decodeStream(self):
+        d = lzma.LZMADecompressor(lzma.FORMAT_XZ)
+        coffset = 0
+        uoffset = 0
+        while True:
+            cdata = self._pread(coffset, READ_SIZE)
+            if not cdata:
+                return
+            coffset += len(cdata)
+            data = d.decompress(cdata)
+            while d.eof and d.unused_data.strip(b'\0'):
+                rest = d.unused_data
+                d = lzma.LZMADecompressor(lzma.FORMAT_XZ)
+                data += d.decompress(rest)
+            yield uoffset, data
+            uoffset += len(data)
+
+    def _blockPieces(self, offset, end):
+        i = bisect_right(self.marks, offset) - 1
+        with self.lock:
+            resume, self.resume = self.resume, None
+        if resume is not None and resume[0] == i and resume[1] <= offset:
+            pieces = resume[2]
+        else:
+            pieces = self._blockData(i)
+        while True:
+            for uoffset, data in pieces:
+                if uoffset + len(data) >= end:
+                    # The caller stops here, a later read may go on
+                    self.resume = (i, uoffset + len(data), pieces)
+                    yield uoffset, data
+                    return
+                yield uoffset, data
+            i += 1
+            if i >= len(self.blocks) or self.blocks[i][0] >= end:
+                return
+            pieces = self._blockData(i)
+
+    def _fetch(self, offset, length):
+        if self.blocks:
+            pieces = self._blockPieces(offset, offset + length)
+        else:
+            pieces = self._decodeStream()
+        return self._collect(pieces, offset, length)
+
+    def suspend(self):
+        return self.f.close()
+
+    def close(self):
+        self.f.close()
+
+
+class HttpSource(CachedSource):
+    '''
+        Image served over HTTP, read with Range requests on one keep-alive
+        connection per thread.
+    '''
+    def __init__(self, url, chunk_size=SOURCE_CHUNK_SIZE, cache_size=SOURCE_CACHE_SIZE, timeout=30,
+                 cache=None):
+        CachedSource.__init__(self, chunk_size, cache_size, cache)
+        self.url = urlsplit(url)
+        self.timeout = timeout
+        self.local = threading.local()
+        status, headers, body = self._request('bytes=0-0')
+        if status == 206:
+            self.size = int(headers.get('Content-Range', '').rsplit('/', 1)[-1])
+        elif status == 200:
+            self.size = int(headers.get('Content-Length', len(body)))
+        else:
+            raise IOError("HTTP %d for %s" % (status, url))
+
+    def _connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            cls = http.client.HTTPSConnection if self.url.scheme == 'https' else http.client.HTTPConnection
+            conn = cls(self.url.netloc, timeout=self.timeout)
+            self.local.conn = conn
+        return conn
+
+    def _request(self, ranges):
+        path = self.url.path or '/'
+        if self.url.query:
+            path += '?' + self.url.query
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request('GET', path, headers={'Range': ranges})
+                response = conn.getresponse()
+                return response.status, response.headers, response.read()
+            except (http.client.HTTPException, ConnectionError):
+                # Keep-alive connection closed by the server, reconnect once
+                conn.close()
+                self.local.conn = None
+                if attempt:
+                    raise
+
+    def _fetch(self, offset, length):
+        status, headers, body = self._request('bytes=%d-%d' % (offset, offset + length - 1))
+        if status == 200:
+            return body[offset:offset + length]
+        if status != 206:
+            raise IOError("HTTP %d reading %d bytes @ %d" % (status, length, offset))
+        return body
+
+
+def openSource(location, cache=None):
+    '''
+        ByteSource for an existing source, an http(s) URL or a path to a
+        plain, gzip or xz compressed image. Sources decoding or fetching
+        data keep it in cache when one is given.
+    '''
+    if isinstance(location, ByteSource):
+        return location
+    if location.startswith('http://') or location.startswith('https://'):
+        return HttpSource(location, cache=cache)
+    with open(location, 'rb') as f:
+        magic = f.read(6)
+    if magic.startswith(GZIP_MAGIC):
+        return GzipSource(location, cache=cache)
+    if magic == XZ_MAGIC:
+        return XzSource(location, cache=cache)
+    return FileSource(location)
@@ -1,12 +1,27 @@
 from fs.squashfs_types import *
 from struct import unpack, calcsize
 from fs.compression import *
+from fs.cache import LRUCache, newTag
+from fs.pathindex import PathIndex
+from fs.filehandle import FileHandle
+from fs.manifest import ContentRun, hashRuns
+from fs.metadata import MetadataTable
+from fs.source import openSource
+from fs.sharedindex import RecordTable, packRecords
+from fs.check import CheckError, runTasks
+from fs.tarexport import TarMember, TAR_TYPES, memberName, writeTar
+import pickle
+import tarfile
+from functools import partial
 from stat import S_IFDIR, S_IFLNK, S_IFREG
 import logging
 
 
 log = logging.getLogger(__name__)
 
+# Range reads ending this close to a block start decode only up to their end
+PARTIAL_READ_SIZE = 16 * 1024
+
 # Info
 # https://github.com/AgentD/squashfs-tools-ng/blob/master/doc/format.txt
 compressors = [DummyCompressor,
@@ -20,18 +35,20 @@ compressors = [DummyCompressor,
 
 def getCompressor(comp_id):
     try:
-        return compressors[comp_id]()
+        return registry.get(compressors[comp_id])
     except Exception:
         raise Exception("Unknown compression: %d" % comp_id)
 
 
 class SquashImage:
-    def __init__(self, path, endianess):
+    def __init__(self, source, endianess, cache=None):
         self.IdTable = None
         self.FragTable = []
         self.endianess = endianess
-        self.tree = {}
-        self.f = open(path, 'rb')
+        self.cache = cache if cache is not None else LRUCache()
+        self.cacheTag = newTag()
+        self.source = openSource(source)
+        self.f = self.source.open()
 
         self.super_block = SuperBlock.unpack(self.f, endianess)
         log.debug(self.super_block)
@@ -46,7 +63,42 @@ class SquashImage:
         self._loadIdTable()
         self._loadInodeTable()
         self._loadFragTable()
-        self.tree['/'] = self._buildTree(self.root_inode)
+        self.paths = PathIndex.build(self.root_inode.inode_number,
+                                     DIRENT_TYPES[self.root_inode.inode_type], self._listDirectory)
+
+    def indexSections(self):
+        '''
+            Parsed tables as flat sections, see fs.sharedindex.
+        '''
+        meta = {'endianess': self.endianess, 'super_block': self.super_block,
+                'IdTable': self.IdTable, 'root_inode': self.root_inode}
+        sections = {'squash.meta': pickle.dumps(meta, pickle.HIGHEST_PROTOCOL)}
+        sections['squash.inodes'], sections['squash.inodes.blob'] = packRecords(self.inodeTable)
+        sections['squash.frags'], sections['squash.frags.blob'] = packRecords(self.FragTable)
+        sections.update(self.paths.sections())
+        return sections
+
+    @classmethod
+    def fromIndex(cls, source, sections, cache=None):
+        '''
+            Image attached to sections of another process, tables are read
+            in place and records unpickled on first use.
+        '''
+        self = cls.__new__(cls)
+        meta = pickle.loads(sections['squash.meta'])
+        self.endianess = meta['endianess']
+        self.super_block = meta['super_block']
+        self.IdTable = meta['IdTable']
+        self.root_inode = meta['root_inode']
+        self.cache = cache if cache is not None else LRUCache()
+        self.cacheTag = newTag()
+        self.source = openSource(source)
+        self.f = self.source.open()
+        self.compressor = getCompressor(self.super_block.compression_id.value)
+        self.inodeTable = RecordTable(sections['squash.inodes'], sections['squash.inodes.blob'])
+        self.FragTable = RecordTable(sections['squash.frags'], sections['squash.frags.blob'])
+        self.paths = PathIndex.attach(sections)
+        return self
 
     def _getMetadataBlob(self):
         hdr = MetadataBlock.unpack(self.f, self.endianess)
@@ -65,7 +117,8 @@ class SquashImage:
         inode_type = unpack(self.endianess + "H",
                             root_blk_data[self.root_blk_off:self.root_blk_off + 2])[0]
         self.root_inode = node_index[inode_type].unpack(root_blk_data[self.root_blk_off:],
-                                                        self.endianess, self.IdTable)
+                                                        self.endianess, self.IdTable,
+                                                        self.super_block.block_size)
 
         self.f.seek(self.super_block.inode_table_start)
         while end > self.f.tell():
@@ -75,10 +128,11 @@ class SquashImage:
         offset = 0
         end = len(inode_data)
         type_fmt = self.endianess + "H"
+        block_size = self.super_block.block_size
         while end > offset:
             inode_type = unpack(type_fmt, inode_data[offset:offset + 2])[0]
-            inode = node_index[inode_type].unpack(inode_data[offset:],
-                                                  self.endianess, self.IdTable)
+            inode = node_index[inode_type].unpack(inode_data[offset:], self.endianess,
+                                                  self.IdTable, block_size)
             self.inodeTable[inode.inode_number] = inode
             offset = offset + inode.dlen
 
@@ -111,8 +165,9 @@ class SquashImage:
                 offset += fbe.dlen
         self.f.seek(curPos)
 
-    def _buildTree(self, inode):
-        result = {'type': inode.inode_type, 'sibs': {}, 'id': inode.inode_number}
+    def _listDirectory(self, inode_number):
+        inode = self.inodeTable[inode_number]
+        result = []
         if inode.inode_number == 0 or inode.file_size <= 3:
             return result
         data = bytearray()
@@ -128,83 +183,443 @@ class SquashImage:
             offset += dirHdr.dlen
             for i in range(0, dirHdr.count + 1):
                 d = DirectoryEntry.unpack(data[offset:], self.endianess)
-                if d.type == 1 or d.type == 8:
-                    node = self.inodeTable[dirHdr.node_number + d.inode_offset]
-                    result['sibs'][d.name] = self._buildTree(node)
-                else:
-                    result['sibs'][d.name] = {'id': dirHdr.node_number + d.inode_offset,
-                                              'type': d.type}
+                result.append((d.name, dirHdr.node_number + d.inode_offset, DIRENT_TYPES[d.type],
+                               d.type == 1 or d.type == 8))
                 offset += d.dlen
         return result
 
     def _getINode(self, path):
-        if path == '/':
-            p = []
-        else:
-            p = path.split('/')[1:]
-        tree = self.tree
-        last = '/'
-        inode = None
-        try:
-            for item in p:
-                tree = tree[last]['sibs']
-                last = item
-            inode = self.inodeTable[tree[last]['id']]
-        except KeyError:
+        nid = self.paths.lookup(path)
+        if nid is None:
             log.debug("[GetINode] Can't find iNode by path: %s" % path)
-            return
-        return inode
+            return None
+        return self.inodeTable[self.paths.inode[nid]]
 
     def listPath(self, path):
-        if path == '/':
-            p = []
+        return self.paths.listPath(path)
+
+    def listEntries(self, path, offset=0):
+        return self.paths.entries(path, offset)
+
+    def walk(self, top='/'):
+        return self.paths.walk(top)
+
+    def glob(self, pattern):
+        return self.paths.glob(pattern)
+
+    def find(self, name=None, type=None, min_size=None):
+        '''
+            Paths of the entries matching all given filters, name is an
+            exact name or a shell pattern, type a find(1) letter and
+            min_size only matches regular files.
+        '''
+        for nid in self.paths.find(name, type):
+            if min_size is not None:
+                inode = self.inodeTable[self.paths.inode[nid]]
+                if inode.inode_type not in (2, 9) or inode.file_size < min_size:
+                    continue
+            yield self.paths.path(nid)
+
+    def _readBlock(self, start, bsize, max_length=None, cached=True):
+        '''
+            With max_length only that much of an uncached block is decoded,
+            the partial result is not cached.
+        '''
+        key = (self.cacheTag, 'blk', start)
+        data = self.cache.get(key) if cached else None
+        if data is None:
+            is_compressed = not (bsize & 0x1000000)
+            dsize = (bsize & 0xFFFFFF)
+            data = self.source[start:start + dsize]
+            log.debug("\t[%d] -> compr %d, dsize %d" % (bsize, is_compressed, dsize))
+            if dsize == 0:
+                # Sparse block
+                data = bytes(self.super_block.block_size)
+            elif is_compressed:
+                ''' The output buffer size is for LZO compression case
+                    otherwise the size will be ignored.
+                '''
+                data = self.compressor.decompress(data, self.super_block.block_size, max_length)
+            if max_length is not None:
+                return data[:max_length]
+            if cached:
+                self.cache.put(key, data)
+        return data
+
+    def _readFragment(self, index):
+        key = (self.cacheTag, 'frag', index)
+        data = self.cache.get(key)
+        if data is None:
+            frag = self.FragTable[index]
+            log.debug(frag)
+            data = self.source[frag.start:frag.start + frag.size]
+            if frag.comp:
+                data = self.compressor.decompress(data, self.super_block.block_size)
+            self.cache.put(key, data)
+        return data
+
+    def _blockStarts(self, inode):
+        starts = [inode.blocks_start]
+        for bsize in inode.block_sizes:
+            starts.append(starts[-1] + (bsize & 0xFFFFFF))
+        return starts
+
+    def _readRange(self, inode, offset, length, starts=None):
+        '''
+            Decodes only the data blocks (and the fragment) overlapping
+            the requested range. starts is the table from _blockStarts,
+            computed here when the caller does not keep one.
+        '''
+        size = inode.file_size
+        length = max(0, min(length, size - offset))
+        if length == 0:
+            return b''
+        bs = self.super_block.block_size
+        first = offset // bs
+        last = (offset + length - 1) // bs
+        nblocks = len(inode.block_sizes)
+        if starts is None:
+            start = inode.blocks_start + sum(bsize & 0xFFFFFF for bsize in inode.block_sizes[:first])
         else:
-            p = path.split('/')[1:]
-        tree = self.tree
-        last = '/'
-        try:
-            for item in p:
-                tree = tree[last]['sibs']
-                last = item
-            if tree[last]['type'] == 1 or tree[last]['type'] == 8:
-                for item in tree[last]['sibs']:
-                    yield item
+            start = starts[min(first, nblocks)]
+        data = bytearray()
+        for block, bsize in enumerate(inode.block_sizes[first:last + 1], first):
+            max_length = None
+            if block == last and offset + length - block * bs <= PARTIAL_READ_SIZE:
+                max_length = offset + length - block * bs
+            data.extend(self._readBlock(start, bsize, max_length))
+            start += bsize & 0xFFFFFF
+        if last >= nblocks and inode.fragment_block_index != 0xFFFFFFFF:
+            frag_data = self._readFragment(inode.fragment_block_index)
+            data.extend(frag_data[inode.block_offset:(inode.block_offset + size - nblocks * bs)])
+        skip = offset - first * bs
+        return bytes(data[skip:skip + length])
+
+    def readRange(self, path, offset, length):
+        inode = self._getINode(path)
+        if inode is None:
+            return None
+        if inode.inode_type != 2:
+            return b''
+        return self._readRange(inode, offset, length)
+
+    def head(self, path, n):
+        '''
+            First n bytes of a file, for file type sniffing.
+        '''
+        return self.readRange(path, 0, n)
+
+    def openFile(self, path):
+        inode = self._getINode(path)
+        if inode is None:
+            return None
+        bs = self.super_block.block_size
+        if inode.inode_type != 2:
+            return FileHandle(inode, 0, bs, None)
+        starts = self._blockStarts(inode)
+        return FileHandle(inode, inode.file_size, bs,
+                          lambda offset, length: self._readRange(inode, offset, length, starts))
+
+    def _blockPiece(self, start, bsize, length):
+        return self._readBlock(start, bsize, cached=False)[:length]
+
+    def _tailPiece(self, inode, tail):
+        return self._readFragment(inode.fragment_block_index)[inode.block_offset:inode.block_offset + tail]
+
+    def _filePieces(self, inode):
+        '''
+            (length, callable) pairs decoding the file content block by
+            block, data blocks are not cached since every run is read once,
+            shared fragment blocks are.
+        '''
+        bs = self.super_block.block_size
+        start = inode.blocks_start
+        remaining = inode.file_size
+        for bsize in inode.block_sizes:
+            # A sparse last block decodes to a full block of zeros
+            yield min(bs, remaining), partial(self._blockPiece, start, bsize, remaining)
+            start += bsize & 0xFFFFFF
+            remaining -= bs
+        tail = inode.file_size - len(inode.block_sizes) * bs
+        if tail > 0 and inode.fragment_block_index != 0xFFFFFFFF:
+            yield tail, partial(self._tailPiece, inode, tail)
+
+    def _fileChunks(self, inode):
+        for length, piece in self._filePieces(inode):
+            yield piece()
+
+    def _dataPosition(self, inode):
+        position = inode.blocks_start
+        if not inode.block_sizes and inode.fragment_block_index != 0xFFFFFFFF:
+            position = self.FragTable[inode.fragment_block_index].start + inode.block_offset
+        return position
+
+    def hashAll(self, algorithm='sha256', jobs=1):
+        '''
+            Hashes every regular file. Files pointing at the same data
+            blocks and fragment slice (hardlinks, deduplicated files) are
+            decoded once.
+        '''
+        runs = {}
+        for nid in self.paths.find(type='f'):
+            inode = self.inodeTable[self.paths.inode[nid]]
+            key = (inode.blocks_start, tuple(inode.block_sizes), inode.fragment_block_index,
+                   inode.block_offset, inode.file_size)
+            run = runs.get(key)
+            if run is None:
+                run = ContentRun(self._dataPosition(inode), inode.file_size, [], partial(self._fileChunks, inode))
+                runs[key] = run
+            run.paths.append(self.paths.path(nid))
+        return hashRuns(runs.values(), algorithm, jobs)
+
+    def exportTar(self, stream, top='/', jobs=1):
+        '''
+            Streams a POSIX tar of top (a directory or a single entry) to
+            stream, see fs.tarexport.writeTar. Returns the bytes written.
+        '''
+        nid = self.paths.lookup(top)
+        if nid is None:
+            raise FileNotFoundError(top)
+        top = self.paths.path(nid)
+        nids = self.paths.descendants(nid)[1:] if self.paths.isdir[nid] else [nid]
+        members = []
+        for nid in nids:
+            path = self.paths.path(nid)
+            ttype = TAR_TYPES.get(self.paths.type[nid])
+            if ttype is None:
+                log.debug("[ExportTar] Skipping %s" % path)
+                continue
+            inode = self.inodeTable[self.paths.inode[nid]]
+            size = position = device = 0
+            pieces = None
+            if ttype == tarfile.REGTYPE:
+                size = inode.file_size
+                position = self._dataPosition(inode)
+                pieces = partial(self._filePieces, inode)
+            elif ttype in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+                device = inode.device
+            members.append(TarMember(memberName(path, top), ttype, inode.permissions, inode.uid, inode.gid,
+                                     inode.modified_time, size, getattr(inode, 'target_path', ''),
+                                     device, inode.inode_number, position, pieces))
+        return writeTar(stream, members, jobs)
+
+    def metadataTable(self):
+        '''
+            Metadata of every node, read from the inode table only. The
+            compressed size of a file includes its share of the fragment
+            block, split by the tail bytes of all files stored in it.
+        '''
+        bs = self.super_block.block_size
+        tails = {}
+        for inode in self.inodeTable:
+            if inode is not None and inode.inode_type in (2, 9) and inode.fragment_block_index != 0xFFFFFFFF:
+                tail = inode.file_size - len(inode.block_sizes) * bs
+                tails[inode.fragment_block_index] = tails.get(inode.fragment_block_index, 0) + tail
+        table = MetadataTable(self.paths)
+        for nid in range(len(self.paths)):
+            inode = self.inodeTable[self.paths.inode[nid]]
+            size = csize = blocks = 0
+            if inode.inode_type in (2, 9):
+                size = inode.file_size
+                csize = sum(bsize & 0xFFFFFF for bsize in inode.block_sizes)
+                blocks = len(inode.block_sizes)
+                tail = size - blocks * bs
+                if tail > 0 and inode.fragment_block_index != 0xFFFFFFFF:
+                    frag = self.FragTable[inode.fragment_block_index]
+                    csize += frag.size * tail // tails[inode.fragment_block_index]
+                    blocks += 1
+            table.append(nid, inode.inode_number, (self.paths.type[nid] << 12) | inode.permissions,
+                         inode.uid, inode.gid, inode.modified_time, size, csize, blocks)
+        return table
+
+    def _checkMetadata(self, kind, start, end, blocks=None):
+        '''
+            Decodes the metadata blocks from start on until end (or until
+            blocks of them were read).
+        '''
+        errors = []
+        pos = start
+        while pos < end and blocks != 0:
+            hdr = unpack(self.endianess + "H", self.source[pos:pos + 2])[0]
+            dlen = hdr & 0x7FFF
+            if dlen == 0 or pos + 2 + dlen > end:
+                errors.append(CheckError('metadata', pos, None,
+                                         "%s block of %d bytes runs past 0x%x" % (kind, dlen, end)))
+                break
+            data = self.source[pos + 2:pos + 2 + dlen]
+            if not hdr & 0x8000:
+                try:
+                    data = self.compressor.decompress(data, 0x2000)
+                except Exception as e:
+                    data = None
+                    errors.append(CheckError('metadata', pos, None, "%s block: %s" % (kind, e)))
+            if data is not None and len(data) > 0x2000:
+                errors.append(CheckError('metadata', pos, None,
+                                         "%s block decodes to %d bytes" % (kind, len(data))))
+            pos += 2 + dlen
+            if blocks is not None:
+                blocks -= 1
+        return errors
+
+    def _tableBlocks(self, start, count, per_block):
+        '''
+            Metadata block offsets stored at start for a table of count
+            entries.
+        '''
+        if count == 0:
+            return []
+        fmt = self.endianess + "%dQ" % int(ceil(count / float(per_block)))
+        return list(unpack(fmt, self.source[start:start + calcsize(fmt)]))
+
+    def _checkRun(self, inode):
+        '''
+            Decodes every data block of a file and compares its size with
+            the one the inode implies.
+        '''
+        errors = []
+        bs = self.super_block.block_size
+        end = self.super_block.bytes_used
+        nblocks = len(inode.block_sizes)
+        has_frag = inode.fragment_block_index != 0xFFFFFFFF
+        start = inode.blocks_start
+        for block, bsize in enumerate(inode.block_sizes):
+            dsize = bsize & 0xFFFFFF
+            expected = bs if block < nblocks - 1 or has_frag else inode.file_size - block * bs
+            if dsize == 0:
+                # Sparse block
+                continue
+            if start + dsize > end:
+                errors.append(CheckError('block', start, inode.inode_number,
+                                         "Block %d of %d bytes runs past the image end" % (block, dsize)))
+                break
+            data = self.source[start:start + dsize]
+            if not bsize & 0x1000000:
+                try:
+                    data = self.compressor.decompress(data, bs)
+                except Exception as e:
+                    data = None
+                    errors.append(CheckError('block', start, inode.inode_number,
+                                             "Block %d: %s" % (block, e)))
+            if data is not None and len(data) != expected:
+                errors.append(CheckError('size', start, inode.inode_number,
+                                         "Block %d decodes to %d bytes, expected %d" % (block, len(data), expected)))
+            start += dsize
+        return errors
+
+    def _checkFragment(self, index, sizes):
+        frag = self.FragTable[index]
+        if frag.start + frag.size > self.super_block.bytes_used:
+            return [CheckError('fragment', frag.start, None,
+                               "Fragment %d of %d bytes runs past the image end" % (index, frag.size))]
+        data = self.source[frag.start:frag.start + frag.size]
+        if frag.comp:
+            try:
+                data = self.compressor.decompress(data, self.super_block.block_size)
+            except Exception as e:
+                return [CheckError('fragment', frag.start, None, "Fragment %d: %s" % (index, e))]
+        if data is None or len(data) > self.super_block.block_size:
+            return [CheckError('fragment', frag.start, None, "Fragment %d does not decode to a block" % index)]
+        sizes[index] = len(data)
+        return []
+
+    def _checkTree(self):
+        '''
+            Cross-references between the directory entries and the inode
+            table: entry types, parent links, link counts and inodes no
+            directory entry points at.
+        '''
+        errors = []
+        paths = self.paths
+        links = {}
+        subdirs = {}
+        for nid in range(len(paths)):
+            ino = paths.inode[nid]
+            inode = self.inodeTable[ino] if 0 < ino < len(self.inodeTable) else None
+            if inode is None:
+                errors.append(CheckError('dirent', None, ino, "%s: no such inode" % paths.path(nid)))
+                continue
+            links[ino] = links.get(ino, 0) + 1
+            if DIRENT_TYPES[inode.inode_type] != paths.type[nid]:
+                errors.append(CheckError('dirent', None, ino, "%s: entry type %d, inode type %d" %
+                                         (paths.path(nid), paths.type[nid], inode.inode_type)))
+            if nid and inode.inode_type in (1, 8):
+                parent = paths.inode[paths.parent[nid]]
+                subdirs[parent] = subdirs.get(parent, 0) + 1
+                if inode.parent_inode_number != parent:
+                    errors.append(CheckError('dirent', None, ino, "%s: parent inode %d, expected %d" %
+                                             (paths.path(nid), inode.parent_inode_number, parent)))
+        for ino in range(1, len(self.inodeTable)):
+            inode = self.inodeTable[ino]
+            if inode is None:
+                errors.append(CheckError('inode', None, ino, "Inode %d missing from the inode table" % ino))
+            elif ino not in links:
+                errors.append(CheckError('orphan-inode', None, ino, "Inode %d is not linked by any entry" % ino))
             else:
-                yield last
-        except KeyError:
-            log.debug("[ListPath] Can't find path: %s" % path)
-            return
+                nlink = 2 + subdirs.get(ino, 0) if inode.inode_type in (1, 8) else links[ino]
+                # Basic file inodes are only used for files without hardlinks
+                count = getattr(inode, 'hard_link_count', 1)
+                if count != nlink:
+                    errors.append(CheckError('nlink', None, ino, "Inode %d has link count %d, found %d" %
+                                             (ino, count, nlink)))
+        return errors
+
+    def check(self, jobs=1, progress=None):
+        '''
+            Integrity check of the whole image: decodes every metadata
+            block, data block and fragment, compares decoded sizes with
+            the block sizes of the inodes and cross-references directory
+            entries and inodes. Blocks are decoded by a thread pool,
+            progress(done, total) is called per finished task. Returns a
+            list of fs.check.CheckError.
+        '''
+        sb = self.super_block
+        frag_blocks = self._tableBlocks(sb.fragment_table_start, sb.fragment_entry_count, 512)
+        id_blocks = self._tableBlocks(sb.id_table_start, sb.id_count, 2048)
+        # The directory table ends where the next table starts
+        dir_end = min(pos for pos in [sb.fragment_table_start, sb.id_table_start, sb.export_table_start,
+                                      sb.xattr_id_table_start, sb.bytes_used] + frag_blocks + id_blocks
+                      if sb.directory_table_start < pos <= sb.bytes_used)
+        tasks = [partial(self._checkMetadata, 'Inode table', sb.inode_table_start, sb.directory_table_start),
+                 partial(self._checkMetadata, 'Directory table', sb.directory_table_start, dir_end)]
+        tasks.extend(partial(self._checkMetadata, 'Fragment table', pos, sb.bytes_used, 1) for pos in frag_blocks)
+        tasks.extend(partial(self._checkMetadata, 'Id table', pos, sb.bytes_used, 1) for pos in id_blocks)
+        sizes = {}
+        tasks.extend(partial(self._checkFragment, index, sizes) for index in range(len(self.FragTable)))
+        runs = {}
+        files = [inode for inode in self.inodeTable if inode is not None and inode.inode_type in (2, 9)]
+        for inode in files:
+            if inode.block_sizes:
+                runs.setdefault((inode.blocks_start, tuple(inode.block_sizes), inode.file_size,
+                                 inode.fragment_block_index != 0xFFFFFFFF), inode)
+        tasks.extend(partial(self._checkRun, inode) for inode in runs.values())
+        errors = [error for result in runTasks(tasks, jobs, progress) for error in result]
+
+        for inode in files:
+            index = inode.fragment_block_index
+            if index == 0xFFFFFFFF:
+                continue
+            tail = inode.file_size - len(inode.block_sizes) * sb.block_size
+            if index >= len(self.FragTable):
+                errors.append(CheckError('fragment', None, inode.inode_number,
+                                         "Fragment index %d out of range" % index))
+            elif index in sizes and (tail <= 0 or inode.block_offset + tail > sizes[index]):
+                errors.append(CheckError('size', None, inode.inode_number,
+                                         "Tail of %d bytes at %d does not fit fragment %d of %d bytes" %
+                                         (tail, inode.block_offset, index, sizes[index])))
+        errors.extend(self._checkTree())
+        log.debug("[Check] %d tasks, %d errors" % (len(tasks), len(errors)))
+        return errors
 
     def getFileData(self, path):
         log.debug(">>>>>>>>>>>>>>>>>getFileData<<<<<<<<<<<<<<<<<<<")
         inode = self._getINode(path)
         if inode is None:
-            log.debug("No inode for: ", path)
+            log.debug("No inode for: %s" % path)
             return None
-        data = bytearray()
         log.debug(inode)
-        if inode.inode_type == 2:
-            self.f.seek(inode.blocks_start)
-            for bsize in inode.block_sizes:
-                is_compressed = not ((bsize & 0x800000) >> 24)
-                dsize = (bsize & 0x7FFFFF)
-                tmp = self.f.read(dsize)
-                log.debug("\t[%d] -> compr %d, dsize %d" % (bsize, is_compressed, dsize))
-                if is_compressed:
-                    ''' The output buffer size is for LZO compression case
-                        otherwise the size will be ignored.
-                    '''
-                    tmp = self.compressor.decompress(tmp, 0x40000)
-                data.extend(tmp)
-            if inode.fragment_block_index != 0xFFFFFFFF:
-                frag = self.FragTable[inode.fragment_block_index]
-                log.debug(frag)
-                self.f.seek(frag.start)
-                frag_data = self.f.read(frag.size)
-                if frag.comp:
-                    frag_data = self.compressor.decompress(frag_data, 0x40000)
-                data.extend(frag_data[inode.block_offset:(inode.block_offset + inode.file_size)])
-        return bytes(data)
+        if inode.inode_type != 2:
+            return b''
+        return self._readRange(inode, 0, inode.file_size)
 
     def getAttrs(self, path):
         inode = self._getINode(path)
@@ -218,6 +633,7 @@ class SquashImage:
                      'st_nlink': 0,
                      'st_size': 0,
                      'st_uid': inode.uid,
+                     'st_ino': inode.inode_number,
                      'st_blocks': 0}
             if inode.inode_type == 2:
                 attrs['st_mode'] = S_IFREG | inode.permissions
@@ -250,20 +666,48 @@ class SquashImage:
         if inode:
             return inode.target_path
 
+    def _readLink(self, nid):
+        return getattr(self.inodeTable[self.paths.inode[nid]], 'target_path', None)
+
+    def realpath(self, path):
+        '''
+            Canonical path inside the image with all symlinks resolved,
+            None when a component is missing or links loop. Raises
+            NotADirectoryError for a path continuing past a file.
+        '''
+        nid = self.paths.resolve(path, self._readLink)
+        return None if nid is None else self.paths.path(nid)
+
+    def stat(self, path, follow_symlinks=True):
+        nid = self.paths.resolve(path, self._readLink, follow_symlinks)
+        return None if nid is None else self.getAttrs(self.paths.path(nid))
+
+    @staticmethod
+    def _closeOwned(source, path):
+        if source is not path:
+            source.close()
+
     @classmethod
-    def createObject(cls, path, loglevel=logging.INFO):
+    def createObject(cls, path, loglevel=logging.INFO, cache=None):
+        '''
+            path is an image file, an http(s) URL or any fs.source.ByteSource.
+        '''
         log.setLevel(loglevel)
-        with open(path, 'rb') as f:
-            data = f.read(4)
-            bmagic = unpack('>I', data)[0]
-            lmagic = unpack('<I', data)[0]
-            endianess = None
-            if bmagic == SQUASHFS_MAGIC:
-                log.info("[CreateObject] Big endian, Squash image.")
-                endianess = ">"
-            elif lmagic == SQUASHFS_MAGIC:
-                log.info("[CreateObject] Little endian, Squash image.")
-                endianess = "<"
-            else:
-                return None
-            return SquashImage(path, endianess)
+        source = openSource(path)
+        data = source.pread(0, 4)
+        if len(data) < 4:
+            cls._closeOwned(source, path)
+            return None
+        bmagic = unpack('>I', data)[0]
+        lmagic = unpack('<I', data)[0]
+        endianess = None
+        if bmagic == SQUASHFS_MAGIC:
+            log.info("[CreateObject] Big endian, Squash image.")
+            endianess = ">"
+        elif lmagic == SQUASHFS_MAGIC:
+            log.info("[CreateObject] Little endian, Squash image.")
+            endianess = "<"
+        else:
+            cls._closeOwned(source, path)
+            return None
+        return SquashImage(source, endianess, cache)
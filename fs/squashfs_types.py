@@ -7,7 +7,6 @@ from textwrap import dedent
 
 SQUASHFS_MAGIC              = 0x73717368
 METADATA_BLOCK_SIZE         = 8 * 1024
-IMAGE_BLOCK_SIZE            = None
 
 SuperblockFlags = {
     'UNCOMPRESSED_INODES'     : 0x0001,
@@ -41,6 +40,10 @@ class InodeType(Enum):
     EXTENDED_SOCKET         = 14
 
 
+# Inode type -> d_type numbering of readdir(3)
+DIRENT_TYPES = [0, 4, 8, 10, 6, 2, 1, 12, 4, 8, 10, 6, 2, 1, 12]
+
+
 class Compression(Enum):
     GZIP                    = 1
     LZMA                    = 2
@@ -73,11 +76,9 @@ class SuperBlock(NamedTuple):
 
     @classmethod
     def unpack(cls, fd, endianess):
-        global IMAGE_BLOCK_SIZE
         f = endianess + "5I6H8Q"
         s = calcsize(f)
         r = unpack(f, fd.read(s))
-        IMAGE_BLOCK_SIZE = r[3]
         return cls(r[0], r[1], r[2], r[3], r[4],
                    Compression(r[5]), r[6], r[7], r[8], r[9],
                    r[10], r[11], r[12], r[13], r[14],
@@ -113,7 +114,7 @@ class BasicDirNode(NamedTuple):
     dlen: int
 
     @classmethod
-    def unpack(cls, data, endianess, idTable):
+    def unpack(cls, data, endianess, idTable, block_size=None):
         f = endianess + "4HIIIIHHI"
         s = calcsize(f)
         r = unpack(f, data[:s])
@@ -157,7 +158,7 @@ class ExtendedDirNode(NamedTuple):
     dlen: int
 
     @classmethod
-    def unpack(cls, data, endianess, idTable):
+    def unpack(cls, data, endianess, idTable, block_size=None):
         f = endianess + "4H2I4I2HI"
         s = calcsize(f)
         r = unpack(f, data[:s])
@@ -188,15 +189,15 @@ class BasicFileNode(NamedTuple):
     dlen: int
 
     @classmethod
-    def unpack(cls, data, endianess, idTable):
+    def unpack(cls, data, endianess, idTable, block_size=None):
         f = endianess + "4H2I4I"
         s = calcsize(f)
         r = unpack(f, data[:s])
 
         if r[7] == 0xFFFFFFFF:
-            blk_sizes_len = int(ceil(r[9] * 1.0 / IMAGE_BLOCK_SIZE))
+            blk_sizes_len = int(ceil(r[9] * 1.0 / block_size))
         else:
-            blk_sizes_len = int(r[9] * 1.0 / IMAGE_BLOCK_SIZE)
+            blk_sizes_len = int(r[9] * 1.0 / block_size)
 
         block_sizes = []
         if blk_sizes_len > 0:
@@ -225,15 +226,15 @@ class ExtendedFileNode(NamedTuple):
     dlen: int
 
     @classmethod
-    def unpack(cls, data, endianess, idTable):
+    def unpack(cls, data, endianess, idTable, block_size=None):
         f = endianess + "4H2I3Q4I"
         s = calcsize(f)
         r = unpack(f, data[:s])
 
         if r[10] == 0xFFFFFFFF:
-            block_sizes_len = int(ceil(r[7] / IMAGE_BLOCK_SIZE * 1.0))
+            block_sizes_len = int(ceil(r[7] / block_size * 1.0))
         else:
-            block_sizes_len = int(r[7] / IMAGE_BLOCK_SIZE)
+            block_sizes_len = int(r[7] / block_size)
 
         block_sizes = []
         if block_sizes_len > 0:
@@ -258,7 +259,7 @@ class BasicSymlinkNode(NamedTuple):
     dlen: int
 
     @classmethod
-    def unpack(cls, data, endianess, idTable):
+    def unpack(cls, data, endianess, idTable, block_size=None):
         f = endianess + "4H2III"
         s = calcsize(f)
         r = unpack(f, data[:s])
@@ -269,7 +270,7 @@ class BasicSymlinkNode(NamedTuple):
 
 class ExtendedSymlinkNode(NamedTuple):
     @classmethod
-    def unpack(cls, data, endianess, idTable):
+    def unpack(cls, data, endianess, idTable, block_size=None):
         raise NotImplementedError
 
 
@@ -286,7 +287,7 @@ class BasicDeviceNode(NamedTuple):
     dlen: int
 
     @classmethod
-    def unpack(cls, data, endianess, idTable):
+    def unpack(cls, data, endianess, idTable, block_size=None):
         f = endianess + "4H2I2I"
         s = calcsize(f)
         r = unpack(f, data[:s])
@@ -296,19 +297,19 @@ class BasicDeviceNode(NamedTuple):
 
 class ExtendedDeviceNode(NamedTuple):
     @classmethod
-    def unpack(cls, data, endianess, idTable):
+    def unpack(cls, data, endianess, idTable, block_size=None):
         raise NotImplementedError
 
 
 class BasicIPCNode(NamedTuple):
     @classmethod
-    def unpack(cls, data, endianess, idTable):
+    def unpack(cls, data, endianess, idTable, block_size=None):
         raise NotImplementedError
 
 
 class ExtendedIPCNode(NamedTuple):
     @classmethod
-    def unpack(cls, data, endianess, idTable):
+    def unpack(cls, data, endianess, idTable, block_size=None):
         raise NotImplementedError
 
 
@@ -0,0 +1,165 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+import logging
+import tarfile
+
+
+log = logging.getLogger(__name__)
+
+# Decoded pieces kept in flight per thread, bounds the memory of an export
+PIPELINE_DEPTH = 4
+END_OF_ARCHIVE = tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+# readdir(3) d_type -> tar type, sockets can't be archived
+TAR_TYPES = {1: tarfile.FIFOTYPE, 2: tarfile.CHRTYPE, 4: tarfile.DIRTYPE, 6: tarfile.BLKTYPE,
+             8: tarfile.REGTYPE, 10: tarfile.SYMTYPE}
+
+
+class TarMember(NamedTuple):
+    '''
+        One archive entry. pieces() yields (length, callable) pairs, the
+        callables decoding the content in order one block each, so no
+        file is ever held in memory whole.
+        position orders regular files as their data is laid out in the
+        image, inode links later members of the same inode as hardlinks.
+    '''
+    name: str
+    type: bytes         # tarfile type, REGTYPE, DIRTYPE, SYMTYPE ...
+    mode: int
+    uid: int
+    gid: int
+    mtime: int
+    size: int
+    linkname: str
+    device: int         # encoded rdev of device nodes
+    inode: int
+    position: int
+    pieces: object
+
+
+def decodeDevice(dev):
+    '''
+        (major, minor) of a Linux new_encode_dev() value, 16 bit values
+        use the old 8:8 encoding.
+    '''
+    if dev <= 0xFFFF:
+        return (dev >> 8) & 0xFF, dev & 0xFF
+    return (dev & 0xFFF00) >> 8, (dev & 0xFF) | ((dev >> 12) & 0xFFF00)
+
+
+def memberName(path, top):
+    '''
+        Archive name of an image path, relative to the exported directory
+        (the base name when a single entry is exported).
+    '''
+    top = top.rstrip('/')
+    if path == top:
+        return path.rsplit('/', 1)[-1]
+    return path[len(top) + 1:]
+
+
+def orderMembers(members):
+    '''
+        Directories first (parents before children), then the other
+        entries with regular files in on-disk order. Every inode after
+        its first member becomes a hardlink to it.
+    '''
+    dirs = [member for member in members if member.type == tarfile.DIRTYPE]
+    others = sorted((member for member in members if member.type != tarfile.DIRTYPE),
+                    key=lambda member: (member.type == tarfile.REGTYPE, member.position))
+    seen = {}
+    for member in others:
+        first = seen.get(member.inode)
+        if first is None:
+            seen[member.inode] = member.name
+            dirs.append(member)
+        else:
+            dirs.append(member._replace(type=tarfile.LNKTYPE, size=0, linkname=first, pieces=None))
+    return dirs
+
+
+def tarHeader(member):
+    info = tarfile.TarInfo(member.name)
+    info.type = member.type
+    info.mode = member.mode & 0o7777
+    info.uid = member.uid
+    info.gid = member.gid
+    info.mtime = member.mtime
+    info.size = member.size if member.type == tarfile.REGTYPE else 0
+    info.linkname = member.linkname
+    if member.type in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+        info.devmajor, info.devminor = decodeDevice(member.device)
+    return info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+
+
+def writeTar(stream, members, jobs=1):
+    '''
+        Writes a POSIX (pax) tar of members to a writable stream, which
+        only needs write() (or sendall(), for a socket). Pieces are
+        decoded by jobs threads (at least one, so decoding overlaps
+        writing) in a bounded window ahead of the writer. Returns the
+        number of bytes written.
+    '''
+    members = orderMembers(members)
+    window = PIPELINE_DEPTH * max(1, jobs)
+    pending = deque()
+    state = {'written': 0, 'member': None, 'left': 0}
+    send = getattr(stream, 'write', None) or stream.sendall
+
+    def write(data):
+        send(data)
+        state['written'] += len(data)
+
+    def finish():
+        member = state['member']
+        if member is None:
+            return
+        if state['left'] > 0:
+            # Pieces ended early, the header already promised the size
+            log.warning("[WriteTar] %s: %d bytes missing, zero filled" % (member.name, state['left']))
+            write(bytes(state['left']))
+        write(tarfile.NUL * (-member.size % tarfile.BLOCKSIZE))
+        state['member'] = None
+
+    def consume(item):
+        kind, value = item
+        if kind == 'header':
+            finish()
+            write(value[1])
+            if value[0].type == tarfile.REGTYPE:
+                state['member'] = value[0]
+                state['left'] = value[0].size
+        else:
+            length, future = value
+            length = min(length, state['left'])
+            try:
+                data = future.result() or b''
+            except Exception as e:
+                log.warning("[WriteTar] %s: can't decode block: %s" % (state['member'].name, e))
+                data = b''
+            if len(data) < length:
+                # Zero filled in place, so the following blocks stay at their offsets
+                log.warning("[WriteTar] %s: block @ %d zero filled" %
+                            (state['member'].name, state['member'].size - state['left']))
+                data = bytes(data) + bytes(length - len(data))
+            state['left'] -= length
+            write(data[:length])
+
+    with ThreadPoolExecutor(max(1, jobs), thread_name_prefix='imageio-tar') as executor:
+        for member in members:
+            pending.append(('header', (member, tarHeader(member))))
+            if member.type == tarfile.REGTYPE and member.pieces is not None:
+                for length, piece in member.pieces():
+                    while len(pending) >= window:
+                        consume(pending.popleft())
+                    pending.append(('data', (length, executor.submit(piece))))
+            while len(pending) > window:
+                consume(pending.popleft())
+        while pending:
+            consume(pending.popleft())
+        finish()
+    write(END_OF_ARCHIVE)
+    # Records are 20 blocks, as written by tar(1) and tarfile
+    write(tarfile.NUL * (-state['written'] % tarfile.RECORDSIZE))
+    log.debug("[WriteTar] %d members, %d bytes" % (len(members), state['written']))
+    return state['written']
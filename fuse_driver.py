@@ -1,26 +1,49 @@
 from errno import ENOENT
 import errno
-from fuse import FUSE, FuseOSError, Operations
+from fuse import FUSE, FuseOSError, Operations, c_stat, set_st_attrs
 import logging
 import argparse
-import fs.squashfs
-import fs.jffs2
+import fs
+from fs.cache import LRUCache
+from fs.profile import AccessProfile, CacheWarmer, imageIdentity, profilePath
+import os
 import sys
 
 
 log = logging.getLogger("imageIO")
 log.setLevel(logging.INFO)
 
+# Images are read-only, so the kernel may keep attributes and entries
+KERNEL_CACHE_TIMEOUT = 86400
 
-supported_filesystems = [fs.squashfs.SquashImage,
-                         fs.jffs2.JffsImage]
+
+class ImageFUSE(FUSE):
+    '''
+        fusepy does not pass the readdir offset on, FSDriver needs it to
+        resume a large directory instead of listing it from the start.
+    '''
+    def readdir(self, path, buf, filler, offset, fip):
+        for name, attrs, off in self.operations('readdir', self._decode_optional_path(path),
+                                                fip.contents.fh, offset):
+            st = None
+            if attrs:
+                st = c_stat()
+                set_st_attrs(st, attrs, use_ns=self.use_ns)
+            if filler(buf, name.encode(self.encoding), st, off) != 0:
+                break
+        return 0
 
 
 class FSDriver(Operations):
 
-    def __init__(self, imgObj):
+    def __init__(self, imgObj, profile=None, warmer=None):
         self.image = imgObj
         self.fd = 0
+        # fh -> fs.filehandle.FileHandle of every file the kernel has open
+        self.handles = {}
+        # Blocks read in this session and the replay of the last one
+        self.profile = profile
+        self.warmer = warmer
 
     # Filesystem methods
     # ==================
@@ -41,11 +64,19 @@ class FSDriver(Operations):
             return attrs
         raise FuseOSError(ENOENT)
 
-    def readdir(self, path, fh):
-        yield '.'
-        yield ".."
-        for item in self.image.listPath(path):
+    def readdir(self, path, fh, offset=0):
+        '''
+            Entries come with their inode number and type and a non-zero
+            offset, so the kernel fetches huge directories a buffer at a
+            time and resumes where it stopped.
+        '''
+        log.debug("[readdir] %s @%d" % (path, offset))
+        for item in [('.', None, 1), ('..', None, 2)][offset:]:
             yield item
+        start = max(0, offset - 2)
+        for pos, (name, ino, dtype) in enumerate(self.image.listEntries(path, start), start + 3):
+            # d_type values are the S_IFMT bits shifted down by 12
+            yield name, {'st_ino': ino, 'st_mode': dtype << 12}, pos
 
     def readlink(self, path):
         trg = self.image.getLnkTarget(path)
@@ -84,16 +115,27 @@ class FSDriver(Operations):
     # ============
 
     def open(self, path, flags):
+        handle = self.image.openFile(path)
+        if handle is None:
+            raise FuseOSError(ENOENT)
         self.fd += 1
+        self.handles[self.fd] = handle
         return self.fd
 
     def create(self, path, mode, fi=None):
         raise FuseOSError(errno.EROFS)
 
     def read(self, path, length, offset, fh):
-        data = self.image.getFileData(path)
-        if data:
-            return data[offset: (offset + length)]
+        if self.warmer is not None:
+            self.warmer.foreground()
+        if self.profile is not None:
+            self.profile.record(path, offset, length)
+        handle = self.handles.get(fh)
+        if handle is not None:
+            return handle.read(offset, length)
+        data = self.image.readRange(path, offset, length)
+        if data is not None:
+            return data
         raise FuseOSError(errno.ENOENT)
 
     def write(self, path, buf, offset, fh):
@@ -103,20 +145,25 @@ class FSDriver(Operations):
         raise FuseOSError(errno.EROFS)
 
     def flush(self, path, fh):
-        pass
+        if fh not in self.handles:
+            raise FuseOSError(errno.EBADF)
 
     def release(self, path, fh):
-        pass
+        handle = self.handles.pop(fh, None)
+        if handle is not None:
+            handle.close()
 
     def fsync(self, path, fdatasync, fh):
         pass
 
 
-def main(fusebox, mountpoint, conf_file=None):
+def main(fusebox, mountpoint, conf_file=None, timeout=KERNEL_CACHE_TIMEOUT):
     # Need to set user_allow_other in /etc/fuse.conf for
     # allow_other option to work (or run this process as root)
     # #fusebox = FuseBox(conf_file)
-    FUSE(fusebox, mountpoint, foreground=True, allow_other=True, nothreads=True)
+    ImageFUSE(fusebox, mountpoint, foreground=True, allow_other=True, nothreads=True,
+              ro=True, use_ino=True, kernel_cache=True, attr_timeout=timeout,
+              entry_timeout=timeout, negative_timeout=timeout)
 
 
 if __name__ == '__main__':
@@ -126,7 +173,23 @@ if __name__ == '__main__':
     p.add_argument("-d", "--debug", action='store_true', dest='debug',
                    help="turn on debugging output")
     p.add_argument("-m", "--mount_point", required=True, help="Mount directory")
-    p.add_argument("rootfs", help="Image file to mount")
+    p.add_argument("-c", "--cache_size", type=int, default=64,
+                   help="Budget in MB for decompressed data kept in memory")
+    p.add_argument("-t", "--cache_timeout", type=float, default=KERNEL_CACHE_TIMEOUT,
+                   help="Seconds the kernel may cache attributes, entries and lookup misses")
+    p.add_argument("-j", "--jobs", type=int, default=1,
+                   help="Number of processes scanning a JFFS2 image at mount")
+    p.add_argument("-e", "--erase_size", type=lambda x: int(x, 0), default=None,
+                   help="JFFS2 erase block size (auto-detected from cleanmarkers if omitted)")
+    p.add_argument("--no_summary", action='store_true',
+                   help="Ignore JFFS2 erase block summaries and scan every node")
+    p.add_argument("--verify", choices=fs.jffs2.VERIFY_POLICIES, default='full',
+                   help="When to check JFFS2 data CRCs: never, on first read, at mount, "
+                        "or at mount in the background")
+    p.add_argument("-p", "--profile_dir", default=None,
+                   help="Directory of access profiles: the blocks read are saved per image at "
+                        "unmount and decoded into the cache in the background on the next mount")
+    p.add_argument("rootfs", help="Image file (plain, gzip or xz) or http(s) URL to mount")
     args = p.parse_args()
     loglevel = logging.INFO
     if args.debug:
@@ -134,10 +197,27 @@ if __name__ == '__main__':
     log.setLevel(level=loglevel)
 
     if args.mount_point and args.rootfs:
-        for fscls in supported_filesystems:
-            imgObj = fscls.createObject(args.rootfs, loglevel)
-            if imgObj:
-                main(FSDriver(imgObj), args.mount_point)
-                sys.exit(0)
+        cache = LRUCache(args.cache_size * 1024 * 1024)
+        fs_options = {fs.JffsImage: {'jobs': args.jobs, 'erase_size': args.erase_size,
+                                     'summary': not args.no_summary,
+                                     'verify': args.verify}}
+        imgObj = fs.openImage(args.rootfs, loglevel, cache, fs_options)
+        if imgObj:
+            profile = warmer = None
+            if args.profile_dir:
+                os.makedirs(args.profile_dir, exist_ok=True)
+                identity = imageIdentity(imgObj)
+                last = AccessProfile.load(profilePath(args.profile_dir, identity), identity)
+                if last is not None:
+                    warmer = CacheWarmer(imgObj, last)
+                    warmer.start()
+                profile = AccessProfile.forImage(imgObj)
+            main(FSDriver(imgObj, profile, warmer), args.mount_point, timeout=args.cache_timeout)
+            if warmer is not None:
+                warmer.stop()
+            if profile is not None and len(profile):
+                profile.save(profilePath(args.profile_dir, profile.identity))
+            log.debug("Cache stats: %s" % cache.stats())
+            sys.exit(0)
         log.warning("Unsupported image type!")
     log.error("Check your parameters!")
@@ -0,0 +1,50 @@
+import argparse
+import logging
+import sys
+import fs
+from fs.cache import LRUCache
+
+
+log = logging.getLogger("imageIO")
+log.setLevel(logging.INFO)
+
+
+def main(imgObj, output, algorithm, jobs):
+    manifest = imgObj.hashAll(algorithm, jobs)
+    manifest.write(output)
+    log.info("%d files, %d distinct data runs, %d of %d bytes decoded, dedup ratio %.2f" %
+             (len(manifest.entries), manifest.runs, manifest.unique_bytes,
+              manifest.logical_bytes, manifest.dedup_ratio))
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    logging.basicConfig(level=logging.INFO)
+
+    p.add_argument("-d", "--debug", action='store_true', dest='debug',
+                   help="turn on debugging output")
+    p.add_argument("-o", "--output", default=None,
+                   help="JSON Lines manifest to write (default: stdout)")
+    p.add_argument("-a", "--algorithm", default="sha256", help="hashlib algorithm")
+    p.add_argument("-j", "--jobs", type=int, default=1,
+                   help="Number of threads decoding and hashing")
+    p.add_argument("-c", "--cache_size", type=int, default=64,
+                   help="Budget in MB for decompressed data kept in memory")
+    p.add_argument("rootfs", help="Image file to hash")
+    args = p.parse_args()
+    loglevel = logging.INFO
+    if args.debug:
+        loglevel = logging.DEBUG
+    log.setLevel(level=loglevel)
+
+    cache = LRUCache(args.cache_size * 1024 * 1024)
+    imgObj = fs.openImage(args.rootfs, loglevel, cache)
+    if imgObj:
+        if args.output:
+            with open(args.output, 'w') as output:
+                main(imgObj, output, args.algorithm, args.jobs)
+        else:
+            main(imgObj, sys.stdout, args.algorithm, args.jobs)
+        sys.exit(0)
+    log.warning("Unsupported image type!")
+    sys.exit(1)
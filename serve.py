@@ -0,0 +1,249 @@
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from stat import S_ISDIR, S_ISLNK
+from urllib.parse import urlsplit, unquote
+import argparse
+import json
+import logging
+import posixpath
+import re
+import select
+import socket
+import sys
+import threading
+import time
+import fs
+from fs.cache import LRUCache
+
+
+log = logging.getLogger("imageIO")
+log.setLevel(logging.INFO)
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+# Seconds a connection may stay idle or blocked on the client
+KEEPALIVE_TIMEOUT = 15
+# Idle connections check this often whether others wait for a worker
+IDLE_POLL = 0.05
+
+
+class ImageRequestHandler(BaseHTTPRequestHandler):
+    '''
+        GET/HEAD of a directory returns its listing as JSON, of a file its
+        content. File content is produced block by block with range reads,
+        so partial downloads only decode the blocks they cover.
+    '''
+    server_version = "imageIO"
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT
+
+    def log_message(self, format, *args):
+        log.debug("[HTTP] %s - %s" % (self.address_string(), format % args))
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self._nextRequest():
+            self.handle_one_request()
+
+    def _nextRequest(self):
+        '''
+            Waits for the next request of a kept alive connection. Gives
+            up (closing it) after the timeout, or as soon as other
+            connections wait for a worker.
+        '''
+        deadline = time.monotonic() + self.timeout
+        wait = 0
+        while True:
+            readable = select.select([self.connection], [], [], wait)[0]
+            # Non-blocking, also sees a pipelined request already buffered
+            self.connection.settimeout(0.0)
+            try:
+                data = self.rfile.peek(1)
+            except OSError:
+                return False
+            finally:
+                self.connection.settimeout(self.timeout)
+            if data:
+                return True
+            if readable or self.server.waiting() or time.monotonic() >= deadline:
+                # End of stream, worker needed elsewhere or idle too long
+                return False
+            wait = IDLE_POLL
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def _imagePath(self):
+        path = posixpath.normpath(unquote(urlsplit(self.path).path))
+        return '/' if path in ('.', '//') else path
+
+    def _sendJson(self, obj, send_body, status=200):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def _sendEmpty(self, status, headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _serve(self, send_body):
+        image = self.server.image
+        path = self._imagePath()
+        attrs = image.getAttrs(path)
+        if attrs is None:
+            self._sendEmpty(404)
+            return
+        if S_ISDIR(attrs['st_mode']):
+            entries = []
+            for name in image.listPath(path):
+                child = image.getAttrs(posixpath.join(path, name)) or {}
+                entries.append({'name': name,
+                                'mode': child.get('st_mode', 0),
+                                'size': child.get('st_size', 0)})
+            self._sendJson({'path': path, 'entries': entries}, send_body)
+        elif S_ISLNK(attrs['st_mode']):
+            self._sendJson({'path': path, 'target': image.getLnkTarget(path)}, send_body)
+        else:
+            self._serveFile(path, attrs, send_body)
+
+    def _serveFile(self, path, attrs, send_body):
+        size = attrs['st_size']
+        # Hardlinks share one inode and so one ETag
+        etag = '"%x-%x-%x"' % (attrs['st_mtime'], size, attrs['st_ino'])
+        headers = [("ETag", etag), ("Accept-Ranges", "bytes")]
+        if etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(',')]:
+            self._sendEmpty(304, headers)
+            return
+        start, end = 0, size
+        status = 200
+        ranges = self.headers.get("Range")
+        match = RANGE_RE.match(ranges.strip()) if ranges else None
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(int(match.group(2)) + 1, size)
+            else:
+                start = max(0, size - int(match.group(2)))
+            if start >= size or start >= end:
+                self._sendEmpty(416, headers + [("Content-Range", "bytes */%d" % size)])
+                return
+            status = 206
+            headers.append(("Content-Range", "bytes %d-%d/%d" % (start, end - 1, size)))
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+        if not send_body:
+            return
+        chunk = self.server.chunkSize
+        pos = start
+        while pos < end:
+            data = self.server.image.readRange(path, pos, min(chunk, end - pos))
+            if not data:
+                # Content-Length was sent, the client can only see the short body on close
+                log.warning("[HTTP] %s: read failed @ %d of %d, closing" % (path, pos, end))
+                self.close_connection = True
+                break
+            self.wfile.write(data)
+            pos += len(data)
+
+
+class ImageServer(HTTPServer):
+    '''
+        HTTP server handling requests in a bounded thread pool on top of
+        the block caches of one opened image. A connection holds a worker
+        while it is kept alive, so idle connections time out and are
+        closed after a request as soon as others are waiting.
+    '''
+    def __init__(self, address, image, threads=8):
+        HTTPServer.__init__(self, address, ImageRequestHandler)
+        self.image = image
+        self.chunkSize = image.getStatFs()['st_blksize']
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='imageio-http')
+        self.connections = set()
+        self.lock = threading.Lock()
+
+    def waiting(self):
+        return len(self.connections) > self.threads
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections.add(request)
+        self.executor.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            with self.lock:
+                self.connections.discard(request)
+            self.shutdown_request(request)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        with self.lock:
+            connections = list(self.connections)
+        # Wakes up workers blocked on a client, queued ones are dropped
+        for request in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        for request in connections:
+            request.close()
+
+
+def main(imgObj, bind, port, threads):
+    server = ImageServer((bind, port), imgObj, threads)
+    log.info("Serving on http://%s:%d/" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    logging.basicConfig(level=logging.INFO)
+
+    p.add_argument("-d", "--debug", action='store_true', dest='debug',
+                   help="turn on debugging output")
+    p.add_argument("-b", "--bind", default="127.0.0.1", help="Address to listen on")
+    p.add_argument("-p", "--port", type=int, default=8000, help="Port to listen on")
+    p.add_argument("-t", "--threads", type=int, default=8,
+                   help="Number of requests handled concurrently")
+    p.add_argument("-c", "--cache_size", type=int, default=64,
+                   help="Budget in MB for decompressed data kept in memory")
+    p.add_argument("rootfs", help="Image file to serve")
+    args = p.parse_args()
+    loglevel = logging.INFO
+    if args.debug:
+        loglevel = logging.DEBUG
+    log.setLevel(level=loglevel)
+
+    cache = LRUCache(args.cache_size * 1024 * 1024)
+    imgObj = fs.openImage(args.rootfs, loglevel, cache)
+    if imgObj:
+        main(imgObj, args.bind, args.port, args.threads)
+        sys.exit(0)
+    log.warning("Unsupported image type!")
+    sys.exit(1)
@@ -0,0 +1,55 @@
+import unittest
+from fs.pathindex import PathIndex
+
+# Inode -> directory entries, inode 1 is the root
+TREE = {
+    1: [('file', 2, 8, False), ('dir', 3, 4, True), ('dangling', 4, 10, False),
+        ('tofile', 5, 10, False), ('todir', 6, 10, False)],
+    3: [('x', 7, 8, False)],
+}
+TARGETS = {4: 'file/x', 5: 'file', 6: 'dir'}
+
+
+class ResolveTest(unittest.TestCase):
+    def setUp(self):
+        self.paths = PathIndex.build(1, 4, lambda inode: TREE.get(inode, []))
+        self.reads = []
+
+    def readLink(self, nid):
+        self.reads.append(nid)
+        return TARGETS[self.paths.inode[nid]]
+
+    def resolve(self, path, follow_symlinks=True):
+        nid = self.paths.resolve(path, self.readLink, follow_symlinks)
+        return None if nid is None else self.paths.inode[nid]
+
+    def test_own_path_past_file(self):
+        for path in ('/file/x', '/file/', '/tofile/x'):
+            with self.assertRaises(NotADirectoryError):
+                self.resolve(path)
+
+    def test_link_target_past_file_is_dangling(self):
+        self.assertIsNone(self.resolve('/dangling'))
+        self.assertIsNone(self.resolve('/dangling/y'))
+        self.assertEqual(self.resolve('/dangling', False), 4)
+
+    def test_links_memoized(self):
+        self.assertEqual(self.resolve('/todir/x'), 7)
+        self.assertEqual(self.resolve('/todir/x'), 7)
+        self.assertEqual(self.resolve('/tofile'), 2)
+        self.assertEqual(self.resolve('/tofile'), 2)
+        self.assertEqual(len(self.reads), 2)
+
+
+class DescendantsTest(unittest.TestCase):
+    def test_descendants(self):
+        paths = PathIndex.build(1, 4, lambda inode: TREE.get(inode, []))
+        nid = paths.child(0, 'dir')
+        self.assertEqual([paths.path(i) for i in paths.descendants(nid)], ['/dir', '/dir/x'])
+        self.assertEqual(paths.descendants(nid, dirs_only=True), [nid])
+        self.assertEqual(len(paths.descendants(0)), len(paths))
+        self.assertEqual(paths.descendants(0, True), [0, nid])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import lzma
+import os
+import random
+import tempfile
+import tracemalloc
+import unittest
+from fs.source import XzSource, openSource
+
+
+def sampleData(size):
+    rnd = random.Random(0)
+    words = [bytes(rnd.getrandbits(8) for i in range(16)) for j in range(256)]
+    return b''.join(rnd.choice(words) for i in range(size // 16))
+
+
+class SingleBlockXzTest(unittest.TestCase):
+    '''
+        Plain `xz -c` output, the whole image in one block.
+    '''
+    @classmethod
+    def setUpClass(cls):
+        cls.data = sampleData(16 * 1024 * 1024)
+        fd, cls.path = tempfile.mkstemp(suffix='.xz')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(lzma.compress(cls.data, preset=1))
+
+    @classmethod
+    def tearDownClass(cls):
+        os.unlink(cls.path)
+
+    def test_single_block(self):
+        source = openSource(self.path)
+        self.assertIsInstance(source, XzSource)
+        self.assertEqual(len(source.blocks), 1)
+        self.assertEqual(len(source), len(self.data))
+
+    def test_small_read_memory(self):
+        source = openSource(self.path)
+        tracemalloc.start()
+        try:
+            self.assertEqual(source.pread(10, 10), self.data[10:20])
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        # Decoder dictionary (1 MiB at preset 1) and a few pieces, not the image
+        self.assertLess(peak, 4 * 1024 * 1024)
+
+    def test_reads(self):
+        source = openSource(self.path)
+        source.cache.maxbytes = 512 * 1024
+        rnd = random.Random(1)
+        for i in range(50):
+            offset = rnd.randrange(len(self.data))
+            length = rnd.randrange(1, 256 * 1024)
+            self.assertEqual(source.pread(offset, length), self.data[offset:offset + length])
+        out = bytearray()
+        for offset in range(0, len(self.data), 100000):
+            out += source.pread(offset, 100000)
+        self.assertEqual(out, self.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
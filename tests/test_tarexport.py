@@ -0,0 +1,35 @@
+import io
+import tarfile
+import unittest
+from fs.tarexport import TarMember, writeTar
+
+
+def failing():
+    raise ValueError("corrupt block")
+
+
+class WriteTarTest(unittest.TestCase):
+    def export(self, pieces, size, jobs=1):
+        member = TarMember('file', tarfile.REGTYPE, 0o644, 0, 0, 0, size, '', 0, 1, 0, lambda: iter(pieces))
+        out = io.BytesIO()
+        written = writeTar(out, [member], jobs)
+        self.assertEqual(written, len(out.getvalue()))
+        out.seek(0)
+        with tarfile.open(fileobj=out) as tar:
+            return tar.extractfile('file').read()
+
+    def test_failing_piece_is_zero_filled_in_place(self):
+        pieces = [(4, lambda: b'AAAA'), (4, failing), (4, lambda: b'CCCC')]
+        for jobs in (1, 4):
+            self.assertEqual(self.export(pieces, 12, jobs), b'AAAA\0\0\0\0CCCC')
+
+    def test_empty_and_short_pieces(self):
+        pieces = [(4, lambda: None), (4, lambda: b'BB'), (4, lambda: b'CCCC')]
+        self.assertEqual(self.export(pieces, 12), b'\0\0\0\0BB\0\0CCCC')
+
+    def test_missing_tail(self):
+        self.assertEqual(self.export([(4, lambda: b'AAAA')], 6), b'AAAA\0\0')
+
+
+if __name__ == '__main__':
+    unittest.main()